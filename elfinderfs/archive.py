@@ -0,0 +1,288 @@
+# Copyright (C) 2014 Okami, okami@fuzetsu.info
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+import errno
+import os
+import stat
+import struct
+import tarfile
+import time
+import zlib
+
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+BLOCK_SIZE = 1 << 20
+ZIP64_LIMIT = (1 << 31) - 1
+ZIP_MAX = 0xffffffff
+
+
+def deflate(block, level, last):
+    '''
+    Raw deflate stream of the block. Streams of the blocks ending with
+    a sync flush are joined into one stream, as pigz does.
+    '''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(
+        zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class Deflater(object):
+    '''
+    Compresses blocks in a thread pool (zlib releases the GIL) and
+    writes them to fileobj in order. Plain bytes and callables, called
+    when it's their turn, can be queued between the blocks. At most
+    2 * workers blocks are kept in memory.
+    '''
+    def __init__(self, fileobj, workers=4, level=6):
+        self.fileobj = fileobj
+        self.level = level
+        self.limit = 2 * workers
+        self.offset = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._queue = deque()
+        self._blocks = 0
+
+    def _pop(self):
+        item = self._queue.popleft()
+        if isinstance(item, Future):
+            self._blocks -= 1
+            item = item.result()
+        elif callable(item):
+            item = item()
+        self.fileobj.write(item)
+        self.offset += len(item)
+
+    def write(self, item):
+        self._queue.append(item)
+
+    def compress(self, block, last=False):
+        self._queue.append(
+            self._executor.submit(deflate, block, self.level, last))
+        self._blocks += 1
+        while self._blocks > self.limit:
+            self._pop()
+
+    def flush(self):
+        while self._queue:
+            self._pop()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown()
+
+    def abort(self):
+        self._queue.clear()
+        self._executor.shutdown()
+
+
+def dos_datetime(mtime):
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+
+class ZipEntry(object):
+    __slots__ = ('name', 'is_dir', 'mode', 'mtime', 'zip64', 'crc',
+                 'usize', 'csize', 'offset', 'start')
+
+    def __init__(self, name, st):
+        self.is_dir = stat.S_ISDIR(st.st_mode)
+        self.name = (name.rstrip('/') + '/' if self.is_dir else name)
+        self.mode = st.st_mode
+        self.mtime = st.st_mtime
+        # sizes are reserved in the local header
+        self.zip64 = not self.is_dir and st.st_size >= ZIP64_LIMIT
+        self.crc = self.usize = self.csize = self.offset = self.start = 0
+
+    @property
+    def flags(self):
+        flags = 0 if self.is_dir else 0x08
+        try:
+            self.name.encode('ascii')
+        except UnicodeEncodeError:
+            flags |= 0x800
+        return flags
+
+
+class ZipStream(object):
+    '''
+    Zip writer for a plain output stream. File data is read in
+    block_size blocks, which are deflated in parallel by the Deflater,
+    sizes and crc are written in the data descriptors after the data.
+    '''
+    def __init__(self, fileobj, workers=4, level=6, block_size=BLOCK_SIZE):
+        self.deflater = Deflater(fileobj, workers, level)
+        self.block_size = block_size
+        self.entries = []
+
+    def _local_header(self, entry):
+        entry.offset = self.deflater.offset
+        name = entry.name.encode('utf-8')
+        dostime, dosdate = dos_datetime(entry.mtime)
+        extra = b''
+        size = 0
+        if entry.zip64:
+            extra = struct.pack('<2H2Q', 1, 16, 0, 0)
+            size = ZIP_MAX
+        header = struct.pack(
+            '<4s5H3L2H', b'PK\x03\x04', 45 if entry.zip64 else 20,
+            entry.flags, 0 if entry.is_dir else zlib.DEFLATED, dostime,
+            dosdate, 0, size, size, len(name), len(extra)) + name + extra
+        entry.start = entry.offset + len(header)
+        return header
+
+    def _descriptor(self, entry):
+        entry.csize = self.deflater.offset - entry.start
+        if entry.zip64:
+            return struct.pack('<4sL2Q', b'PK\x07\x08', entry.crc,
+                               entry.csize, entry.usize)
+        return struct.pack('<4s3L', b'PK\x07\x08', entry.crc,
+                           entry.csize, entry.usize)
+
+    def add(self, rpath, arcname):
+        ''' adds file or dir (without its contents) '''
+        entry = ZipEntry(arcname, os.stat(rpath))
+        self.entries.append(entry)
+        self.deflater.write(lambda: self._local_header(entry))
+        if entry.is_dir:
+            return
+        crc = size = 0
+        with open(rpath, 'rb') as f:
+            while True:
+                block = f.read(self.block_size)
+                crc = zlib.crc32(block, crc)
+                size += len(block)
+                last = len(block) < self.block_size
+                self.deflater.compress(block, last)
+                if last:
+                    break
+        if size >= ZIP64_LIMIT and not entry.zip64:
+            # the file has grown since it was stat'ed
+            raise OSError(errno.EFBIG, os.strerror(errno.EFBIG), rpath)
+        entry.crc, entry.usize = crc, size
+        self.deflater.write(lambda: self._descriptor(entry))
+
+    def _central_header(self, entry):
+        name = entry.name.encode('utf-8')
+        dostime, dosdate = dos_datetime(entry.mtime)
+        usize, csize, offset = entry.usize, entry.csize, entry.offset
+        extra = []
+        if usize > ZIP64_LIMIT or csize > ZIP64_LIMIT:
+            extra += [usize, csize]
+            usize = csize = ZIP_MAX
+        if offset > ZIP64_LIMIT:
+            extra.append(offset)
+            offset = ZIP_MAX
+        extra = extra and struct.pack(
+            '<2H%dQ' % len(extra), 1, 8 * len(extra), *extra) or b''
+        version = 45 if extra or entry.zip64 else 20
+        external = (entry.mode & 0xffff) << 16 | (0x10 if entry.is_dir else 0)
+        return struct.pack(
+            '<4s4B4HL2L5H2L', b'PK\x01\x02', version, 3, version, 0,
+            entry.flags, 0 if entry.is_dir else zlib.DEFLATED, dostime,
+            dosdate, entry.crc, csize, usize, len(name), len(extra), 0, 0,
+            0, external, offset) + name + extra
+
+    def close(self):
+        deflater = self.deflater
+        deflater.flush()
+        start = deflater.offset
+        for entry in self.entries:
+            deflater.write(self._central_header(entry))
+        deflater.flush()
+        size = deflater.offset - start
+        count = len(self.entries)
+        if count > 0xffff or start > ZIP64_LIMIT or size > ZIP64_LIMIT:
+            deflater.write(struct.pack(
+                '<4sQ2H2L4Q', b'PK\x06\x06', 44, 45, 45, 0, 0, count,
+                count, size, start))
+            deflater.write(struct.pack(
+                '<4sLQL', b'PK\x06\x07', 0, start + size, 1))
+            count = min(count, 0xffff)
+            size = min(size, ZIP_MAX)
+            start = min(start, ZIP_MAX)
+        deflater.write(struct.pack(
+            '<4s4H2LH', b'PK\x05\x06', 0, 0, count, count, size, start, 0))
+        deflater.close()
+
+
+class GzipStream(object):
+    '''
+    Write-only gzip file, its data is deflated in parallel
+    by block_size blocks.
+    '''
+    def __init__(self, fileobj, workers=4, level=6, block_size=BLOCK_SIZE):
+        self.deflater = Deflater(fileobj, workers, level)
+        self.block_size = block_size
+        self.crc = self.size = 0
+        self._buffer = bytearray()
+        self.deflater.write(b'\x1f\x8b\x08\x00' + struct.pack(
+            '<L', int(time.time())) + b'\x00\x03')
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            self.deflater.compress(bytes(self._buffer[:self.block_size]))
+            del self._buffer[:self.block_size]
+        return len(data)
+
+    def close(self):
+        self.deflater.compress(bytes(self._buffer), last=True)
+        self.deflater.write(struct.pack(
+            '<2L', self.crc, self.size & 0xffffffff))
+        self.deflater.close()
+
+
+def write_zip(fileobj, members, workers=4, level=6):
+    ''' writes (rpath, arcname) members as zip archive '''
+    archive = ZipStream(fileobj, workers, level)
+    try:
+        for rpath, arcname in members:
+            archive.add(rpath, arcname)
+    except BaseException:
+        archive.deflater.abort()
+        raise
+    archive.close()
+
+
+def write_tar_gz(fileobj, members, workers=4, level=6):
+    ''' writes (rpath, arcname) members as tar.gz archive '''
+    stream = GzipStream(fileobj, workers, level)
+    try:
+        # stream mode, tarfile never seeks
+        with tarfile.open(fileobj=stream, mode='w|',
+                          format=tarfile.PAX_FORMAT) as tar:
+            for rpath, arcname in members:
+                tar.add(rpath, arcname, recursive=False)
+    except BaseException:
+        stream.deflater.abort()
+        raise
+    stream.close()
+
+
+# mime: (extension, writer)
+ARCHIVERS = OrderedDict((
+    ('application/zip', ('.zip', write_zip)),
+    ('application/x-gzip', ('.tar.gz', write_tar_gz)),
+))
@@ -0,0 +1,133 @@
+# Copyright (C) 2014 Okami, okami@fuzetsu.info
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+import os
+import socket
+import threading
+import time
+
+from collections import OrderedDict
+from hashlib import md5
+
+from django.core.cache import caches
+
+from . import inotify
+from .fs import MtimeCache
+from .jobs import alive
+
+
+class ListingCache(object):
+    '''
+    Dir listings shared by the worker processes through the django
+    cache. An entry is used while the dir mtime is the same. On Linux
+    dirs are watched with inotify, so entries are dropped when files
+    inside the dir are changed too. Dirs which can't be watched are
+    not cached there.
+
+    Each entry records the process watching the dir, which drops the
+    entry when the dir changes or its watch is released. Other
+    processes of the host use the entry while that process is alive,
+    changes made while nobody watched the dir would be missed
+    otherwise. Watches not used for timeout seconds or above
+    max_watches per process are released.
+    '''
+    def __init__(self, alias, timeout=None, max_watches=1024):
+        self.alias = alias
+        self.timeout = timeout
+        self.max_watches = max_watches
+        self._watcher = None
+        self._pid = None
+        self._used = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    @property
+    def watcher(self):
+        ''' inotify watcher of the current process, None if unavailable '''
+        if not inotify.available():
+            return None
+        with self._lock:
+            # file descriptors and threads don't survive fork
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._used = OrderedDict()
+                try:
+                    self._watcher = inotify.Inotify(self.invalidate)
+                except OSError:
+                    self._watcher = None
+            return self._watcher
+
+    def key(self, rpath):
+        return 'elfinderfs:ls:%s' % md5(os.fsencode(rpath)).hexdigest()
+
+    def _touch(self, watcher, rpath):
+        ''' marks the watch used, releases expired ones '''
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            self._used[rpath] = now
+            self._used.move_to_end(rpath)
+            while self._used:
+                oldest, used = next(iter(self._used.items()))
+                if not (len(self._used) > self.max_watches or
+                        self.timeout and now - used > self.timeout):
+                    break
+                self._used.popitem(last=False)
+                expired.append(oldest)
+        for rpath in expired:
+            watcher.unwatch(rpath)
+            # other processes trust the entry while it's watched
+            self.invalidate(rpath)
+
+    def _owner(self):
+        return socket.gethostname(), os.getpid()
+
+    def _watched(self, owner):
+        ''' the process which set the entry still watches the dir '''
+        host, pid = owner
+        return (host == socket.gethostname() and pid != os.getpid() and
+                alive(pid))
+
+    def get(self, rpath, mtime_ns):
+        ''' list of (name, NodeStat values) or None '''
+        value = self.cache.get(self.key(rpath))
+        if value is None or value[0] != mtime_ns:
+            return None
+        if inotify.available():
+            watcher = self.watcher
+            if watcher and watcher.watching(rpath):
+                self._touch(watcher, rpath)
+            elif not self._watched(value[2]):
+                # nobody watches it, it's read again and watched
+                return None
+        return value[1]
+
+    def set(self, rpath, mtime_ns, entries):
+        if time.time_ns() - mtime_ns <= MtimeCache.racy_ns:
+            return
+        if inotify.available():
+            watcher = self.watcher
+            if not (watcher and watcher.watch(rpath)):
+                return
+            self._touch(watcher, rpath)
+        self.cache.set(self.key(rpath), (mtime_ns, entries, self._owner()),
+                       self.timeout)
+
+    def invalidate(self, rpath):
+        self.cache.delete(self.key(rpath))
@@ -0,0 +1,363 @@
+# Copyright (C) 2014 Okami, okami@fuzetsu.info
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+import codecs
+import errno
+import os
+import shutil
+import stat
+import threading
+import time
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# linux ioctl sharing the source blocks with the destination file
+FICLONE = 0x40049409
+# errors meaning the fast path is not supported for the given files
+COPY_FALLBACK_ERRNOS = frozenset(filter(None, (
+    errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EBADF, errno.ENOTTY,
+    errno.EPERM, getattr(errno, 'EOPNOTSUPP', None),
+    getattr(errno, 'ENOTSUP', None))))
+
+EUID = os.geteuid() if hasattr(os, 'geteuid') else None
+GROUPS = (frozenset(os.getgroups()) | {os.getegid()}
+          if hasattr(os, 'getgroups') else frozenset())
+
+
+class NodeStat(object):
+    '''
+    Snapshot of file/dir metadata taken with a single stat call.
+    All InfoNode properties are computed from it. dir_access is
+    the dir_access() result of a dir, it's looked up once per snapshot
+    and is not a part of values().
+    '''
+    fields = ('is_dir', 'is_link', 'mode', 'uid', 'gid',
+              'size', 'mtime', 'mtime_ns', 'dev', 'ino')
+    __slots__ = fields + ('dir_access',)
+
+    def __init__(self, st, is_link=False):
+        self.dir_access = None
+        self.is_dir = stat.S_ISDIR(st.st_mode)
+        self.is_link = is_link
+        self.mode = st.st_mode
+        self.uid = st.st_uid
+        self.gid = st.st_gid
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        self.mtime_ns = st.st_mtime_ns
+        self.dev = st.st_dev
+        self.ino = st.st_ino
+
+    @classmethod
+    def from_path(cls, rpath):
+        st = os.lstat(rpath)
+        is_link = stat.S_ISLNK(st.st_mode)
+        if is_link:
+            st = os.stat(rpath)
+        return cls(st, is_link)
+
+    @classmethod
+    def from_values(cls, values):
+        ''' restores snapshot from values() '''
+        snapshot = cls.__new__(cls)
+        for name, value in zip(cls.fields, values):
+            setattr(snapshot, name, value)
+        snapshot.dir_access = None
+        return snapshot
+
+    def values(self):
+        return tuple(map(lambda x: getattr(self, x), self.fields))
+
+    @classmethod
+    def from_entry(cls, entry):
+        ''' DirEntry keeps its own cache, so this is free on Windows '''
+        is_link = entry.is_symlink()
+        try:
+            st = entry.stat()
+        except OSError:
+            # broken symlink
+            st = entry.stat(follow_symlinks=False)
+        return cls(st, is_link)
+
+    def access(self, mask):
+        '''
+        os.access() equivalent based on the snapshot mode bits. ACLs,
+        read-only mounts and NFS root_squash are not seen here, see
+        dir_access() for the kernel verdict.
+        '''
+        if EUID is None:
+            return self.mode & (mask << 6) == mask << 6
+        if EUID == 0:
+            return (not mask & os.X_OK or self.is_dir or
+                    bool(self.mode & 0o111))
+        if self.uid == EUID:
+            shift = 6
+        elif self.gid in GROUPS:
+            shift = 3
+        else:
+            shift = 0
+        return (self.mode >> shift) & mask == mask
+
+
+def dir_access(rpath):
+    '''
+    (writable, read-only filesystem) of the dir as the kernel sees
+    it, ACLs, read-only mounts and NFS root_squash included.
+    '''
+    if os.access(rpath, os.W_OK):
+        return True, False
+    try:
+        return False, bool(os.statvfs(rpath).f_flag & os.ST_RDONLY)
+    except (AttributeError, OSError):
+        return False, False
+
+
+def detect_encoding(sample, fallback='latin-1'):
+    '''
+    Guesses text encoding from the first bytes of a file:
+    BOM, then UTF-8, then the fallback one.
+    '''
+    for bom, encoding in ((codecs.BOM_UTF8, 'utf-8-sig'),
+                          (codecs.BOM_UTF16_LE, 'utf-16'),
+                          (codecs.BOM_UTF16_BE, 'utf-16')):
+        if sample.startswith(bom):
+            return encoding
+    try:
+        # the sample may end in the middle of a character
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+    except UnicodeDecodeError:
+        return fallback
+    return 'utf-8'
+
+
+def decodes(f, encoding, block_size=64 * 1024):
+    ''' the rest of the binary file f decodes with encoding '''
+    decoder = codecs.getincrementaldecoder(encoding)()
+    try:
+        for block in iter(lambda: f.read(block_size), b''):
+            decoder.decode(block)
+        decoder.decode(b'', final=True)
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+def scandir(rpath, show_hidden=False):
+    '''
+    Single pass directory listing. Yields DirEntry objects, hidden
+    files and symlinks are skipped unless show_hidden is set.
+    '''
+    with os.scandir(rpath) as entries:
+        for entry in entries:
+            if show_hidden or not (entry.name.startswith('.') or
+                                   entry.is_symlink()):
+                yield entry
+
+
+def subtree_range(path):
+    '''
+    Bounds of the paths under path for range queries,
+    "0" follows "/" in ASCII.
+    '''
+    prefix = path.rstrip(os.sep)
+    return prefix + os.sep, prefix + chr(ord(os.sep) + 1)
+
+
+def walk(rpath, show_hidden=False, skip=()):
+    '''
+    Tree walk built on scandir(). Yields (dir rpath, DirEntry list)
+    pairs, paths listed in skip are left out and never descended into.
+    Symlinked dirs are not followed.
+    '''
+    stack = [rpath]
+    while stack:
+        top = stack.pop()
+        try:
+            entries = [x for x in scandir(top, show_hidden)
+                       if x.path not in skip]
+        except OSError:
+            continue
+        yield top, entries
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+
+
+def has_subdirs(rpath, show_hidden=False):
+    ''' Stops scanning at the first child directory '''
+    return any(entry.is_dir() for entry in scandir(rpath, show_hidden))
+
+
+def _clone(fsrc, fdst):
+    ''' reflink, a copy-on-write filesystem (btrfs, xfs) copies nothing '''
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError as e:
+        if e.errno not in COPY_FALLBACK_ERRNOS:
+            raise
+        return False
+    return True
+
+
+def _copy_range(fsrc, fdst):
+    '''
+    In-kernel copy, may be offloaded to the storage (nfs server side
+    copy). Unsupported on cross filesystem copies by older kernels.
+    '''
+    if not hasattr(os, 'copy_file_range'):
+        return False
+    size = os.fstat(fsrc.fileno()).st_size
+    copied = 0
+    try:
+        while copied < size:
+            n = os.copy_file_range(fsrc.fileno(), fdst.fileno(),
+                                   size - copied)
+            if not n:
+                break
+            copied += n
+    except OSError as e:
+        if copied or e.errno not in COPY_FALLBACK_ERRNOS:
+            raise
+        return False
+    # some filesystems copy nothing instead of failing
+    return copied > 0 or not size
+
+
+def copyfile(src, dst):
+    '''
+    shutil.copyfile() trying reflink and copy_file_range() first.
+    shutil itself falls back to sendfile() on Linux.
+    '''
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        if _clone(fsrc, fdst) or _copy_range(fsrc, fdst):
+            return dst
+    return shutil.copyfile(src, dst)
+
+
+def copy2(src, dst):
+    ''' shutil.copy2() built on copyfile() '''
+    copyfile(src, dst)
+    shutil.copystat(src, dst)
+    return dst
+
+
+def copytree(src, dst, workers=8):
+    '''
+    shutil.copytree() with file data copied in a thread pool. Files are
+    created empty in the walk, so the dir stats copied by copytree are
+    not touched by the workers writing the data afterwards.
+    '''
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+
+        def copy(s, d):
+            open(d, 'wb').close()
+            futures.append(executor.submit(copy2, s, d))
+            return d
+
+        shutil.copytree(src, dst, copy_function=copy)
+        for future in futures:
+            future.result()
+    return dst
+
+
+class MtimeCache(object):
+    '''
+    LRU cache of values computed from dir contents, keyed by dir path
+    and mtime. Adding, removing or renaming an entry updates the dir
+    mtime, so a cached value is reused until the dir changes.
+    '''
+    # mtime resolution may be coarse, fresh dirs are not cached
+    racy_ns = 2 * 10 ** 9
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, mtime_ns, compute):
+        with self._lock:
+            cached = self._data.get(key)
+            if cached is not None and cached[0] == mtime_ns:
+                self._data.move_to_end(key)
+                return cached[1]
+        value = compute()
+        if time.time_ns() - mtime_ns > self.racy_ns:
+            with self._lock:
+                self._data[key] = mtime_ns, value
+                self._data.move_to_end(key)
+                if len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+        return value
+
+
+subdirs_cache = MtimeCache()
+
+
+class DirSizes(object):
+    '''
+    Recursive disk usage of dirs, scanned level by level in a thread
+    pool. Nothing is cached: a file rewritten in place doesn't change
+    the dir mtime, and subdirs come with the scandir() needed for the
+    file sizes anyway.
+    '''
+    def _scan(self, rpath, show_hidden):
+        ''' (sum of the direct files, subdirs) of the dir '''
+        own, subdirs = 0, []
+        try:
+            for entry in scandir(rpath, show_hidden):
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                else:
+                    own += entry.stat(follow_symlinks=False).st_size
+        except OSError:
+            pass
+        return own, subdirs
+
+    def size(self, rpaths, show_hidden=False, workers=8, limit=None):
+        '''
+        Total size of the dirs. If limit is given, scanning stops as soon
+        as the total exceeds it and the partial total is returned.
+        '''
+        total = 0
+        level = list(map(os.path.normpath, rpaths))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while level:
+                futures = list(map(
+                    lambda x: executor.submit(self._scan, x, show_hidden),
+                    level))
+                level = []
+                for future in futures:
+                    own, subdirs = future.result()
+                    total += own
+                    level += subdirs
+                    if limit is not None and total > limit:
+                        for pending in futures:
+                            pending.cancel()
+                        return total
+        return total
+
+
+dir_sizes = DirSizes()
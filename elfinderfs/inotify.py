@@ -0,0 +1,121 @@
+# Copyright (C) 2014 Okami, okami@fuzetsu.info
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+import ctypes
+import ctypes.util
+import os
+import struct
+import sys
+import threading
+
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_ONLYDIR = 0x01000000
+IN_CLOEXEC = 0o2000000
+
+EVENT = struct.Struct('iIII')
+
+
+def available():
+    return sys.platform.startswith('linux')
+
+
+class Inotify(object):
+    '''
+    One-shot dir watcher built on the libc inotify calls. Calls
+    callback(rpath) from a background thread when anything changes
+    in the watched dir (including file contents), then forgets the
+    dir until it's watched again.
+    '''
+    mask = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+            IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+            IN_MOVE_SELF | IN_ONLYDIR)
+
+    def __init__(self, callback):
+        self.callback = callback
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                 use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_CLOEXEC)
+        if self._fd < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code))
+        self._paths = {}
+        self._wds = {}
+        self._lock = threading.Lock()
+        thread = threading.Thread(target=self._run, name='elfinderfs-inotify')
+        thread.daemon = True
+        thread.start()
+
+    def watch(self, rpath):
+        ''' returns False if the dir can't be watched '''
+        with self._lock:
+            if rpath in self._paths:
+                return True
+            wd = self._libc.inotify_add_watch(
+                self._fd, os.fsencode(rpath), self.mask)
+            if wd < 0:
+                # e.g. fs.inotify.max_user_watches is reached
+                return False
+            self._paths[rpath] = wd
+            self._wds[wd] = rpath
+            return True
+
+    def watching(self, rpath):
+        with self._lock:
+            return rpath in self._paths
+
+    def unwatch(self, rpath):
+        with self._lock:
+            wd = self._paths.get(rpath)
+        if wd is not None:
+            self._forget(wd)
+
+    def _forget(self, wd):
+        with self._lock:
+            rpath = self._wds.pop(wd, None)
+            if rpath is not None:
+                self._paths.pop(rpath, None)
+                self._libc.inotify_rm_watch(self._fd, wd)
+            return rpath
+
+    def _run(self):
+        while True:
+            data = os.read(self._fd, 64 * 1024)
+            changed = set()
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+                offset += EVENT.size + length
+                if mask & IN_Q_OVERFLOW:
+                    # events are lost, all dirs are treated as changed
+                    changed.update(map(self._forget, list(self._wds)))
+                else:
+                    changed.add(self._forget(wd))
+            for rpath in changed:
+                if rpath is not None:
+                    try:
+                        self.callback(rpath)
+                    except Exception:
+                        pass
@@ -0,0 +1,172 @@
+# Copyright (C) 2014 Okami, okami@fuzetsu.info
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+import importlib
+import json
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import closing
+
+
+class JobStore(object):
+    '''
+    SQLite store of the background jobs state shared by all worker
+    processes. pid is the process the job belongs to, a pending or
+    running job of a dead process is failed when it's looked up.
+    WAL is used only if wal is set, see SearchIndex.
+    '''
+    schema = (
+        'CREATE TABLE IF NOT EXISTS jobs ('
+        'id TEXT PRIMARY KEY, cmd TEXT NOT NULL, status TEXT NOT NULL, '
+        'done INTEGER NOT NULL DEFAULT 0, total INTEGER NOT NULL, '
+        'result TEXT, error TEXT, pid INTEGER, updated REAL NOT NULL)'
+    )
+    fields = 'id', 'cmd', 'status', 'done', 'total', 'result', 'error', 'pid'
+
+    def __init__(self, path, wal=False):
+        self.path = path
+        self.wal = wal
+
+    def connect(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        if self.wal:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(self.schema)
+        return conn
+
+    def create(self, cmd, total):
+        ''' adds pending job, returns its id '''
+        job_id = uuid.uuid4().hex
+        with closing(self.connect()) as conn, conn:
+            conn.execute(
+                'INSERT INTO jobs (id, cmd, status, total, pid, updated) '
+                "VALUES (?, ?, 'pending', ?, ?, ?)",
+                (job_id, cmd, total, os.getpid(), time.time()))
+        return job_id
+
+    def update(self, job_id, **values):
+        values['updated'] = time.time()
+        with closing(self.connect()) as conn, conn:
+            conn.execute('UPDATE jobs SET %s WHERE id = ?' % ', '.join(
+                map(lambda x: '%s = ?' % x, values.keys())),
+                list(values.values()) + [job_id])
+
+    def get(self, job_id):
+        ''' job record or None, result is decoded '''
+        if not os.path.exists(self.path):
+            return None
+        with closing(self.connect()) as conn:
+            row = conn.execute('SELECT %s FROM jobs WHERE id = ?' % ', '.join(
+                self.fields), (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(self.fields, row))
+        if job['status'] in ('pending', 'running') and not alive(job['pid']):
+            job.update(status='error', error='errUnknown')
+            self.update(job_id, status='error', error='errUnknown')
+        job['result'] = job['result'] and json.loads(job['result'])
+        return job
+
+    def prune(self, age):
+        ''' removes jobs not updated for age seconds '''
+        if os.path.exists(self.path):
+            with closing(self.connect()) as conn, conn:
+                conn.execute('DELETE FROM jobs WHERE updated < ?',
+                             (time.time() - age,))
+
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def setup():
+    ''' initializer of the worker processes '''
+    import django
+    django.setup()
+
+
+def run(store, job_id, task, args):
+    '''
+    Runs task, "module.function" name, in a worker process. The task
+    is called with progress(done) keyword argument and must return
+    a json serializable result.
+    '''
+    store.update(job_id, status='running', pid=os.getpid())
+    module, name = task.rsplit('.', 1)
+    func = getattr(importlib.import_module(module), name)
+    try:
+        result = func(*args, progress=lambda x: store.update(job_id, done=x))
+    except PermissionError:
+        store.update(job_id, status='error', error='errPerm')
+    except FileNotFoundError:
+        store.update(job_id, status='error', error='errFileNotFound')
+    except Exception:
+        store.update(job_id, status='error', error='errUnknown')
+    else:
+        store.update(job_id, status='done', result=json.dumps(result))
+
+
+class JobQueue(object):
+    '''
+    Runs long file operations in worker processes, so requests return
+    at once. Job state is kept in the JobStore at store_path.
+    '''
+    def __init__(self, store_path, workers=2, keep=86400, wal=False):
+        self.store = JobStore(store_path, wal)
+        self.workers = workers
+        self.keep = keep
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            # fork is not safe in threaded web servers
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=setup)
+        return self._executor
+
+    def submit(self, cmd, total, task, *args):
+        ''' queues task, returns job id '''
+        self.store.prune(self.keep)
+        job_id = self.store.create(cmd, total)
+        with self._lock:
+            try:
+                self.executor.submit(run, self.store, job_id, task, args)
+            except BrokenProcessPool:
+                self._executor = None
+                self.executor.submit(run, self.store, job_id, task, args)
+        return job_id
+
+    def get(self, job_id):
+        return self.store.get(job_id)
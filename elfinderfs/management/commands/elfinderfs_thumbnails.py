@@ -0,0 +1,36 @@
+# Copyright (C) 2014 Okami, okami@fuzetsu.info
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+from django.core.management.base import BaseCommand
+
+from elfinderfs.models import Node
+
+
+class Command(BaseCommand):
+    help = ('Removes orphaned thumbnails of the elFinder roots and '
+            'enforces thumbnails_max_size.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'roots', nargs='*',
+            help='Names of the roots to clean up, all roots by default.')
+
+    def handle(self, *args, **options):
+        for root in Node.roots():
+            if options['roots'] and root._root not in options['roots']:
+                continue
+            count = root.collect_thumbnails()
+            self.stdout.write('%s: %s thumbnails removed' % (root._root, count))
@@ -0,0 +1,66 @@
+# Copyright (C) 2014 Okami, okami@fuzetsu.info
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+import datetime
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from elfinderfs.models import Node
+
+
+class Command(BaseCommand):
+    help = ('Lists, restores or purges deleted files kept in the trash '
+            'of the elFinder roots.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'roots', nargs='*',
+            help='Names of the roots, all roots by default.')
+        parser.add_argument(
+            '--restore', metavar='PATH',
+            help='Restores the latest deleted node with the given path.')
+        parser.add_argument(
+            '--purge', action='store_true',
+            help='Removes everything from the trash now.')
+
+    def handle(self, *args, **options):
+        restored = False
+        for root in Node.roots():
+            if options['roots'] and root._root not in options['roots']:
+                continue
+            trash = root._trash
+            if trash is None:
+                continue
+            if options['restore']:
+                node = Node(root=root._root,
+                            path=os.path.normpath(options['restore']))
+                if trash.restore(node._path, node._rpath):
+                    restored = True
+                    node._invalidate_listing()
+                    node.add_to_index()
+                    self.stdout.write('%s: %s restored' % (root._root,
+                                                           node._path))
+            elif options['purge']:
+                trash.purge(force=True)
+            else:
+                for deleted_at, path, rpath in trash.entries():
+                    self.stdout.write('%s: %s %s' % (
+                        root._root, datetime.datetime.fromtimestamp(
+                            deleted_at).isoformat(' ', 'seconds'), path))
+        if options['restore'] and not restored:
+            raise CommandError('%s is not in the trash or the path is taken'
+                               % options['restore'])
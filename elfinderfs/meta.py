@@ -0,0 +1,133 @@
+# Copyright (C) 2014 Okami, okami@fuzetsu.info
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+import os
+import sqlite3
+
+from contextlib import closing
+
+from .fs import subtree_range
+
+
+class MetaStore(object):
+    '''
+    Per-root SQLite store of image metadata shared by all worker
+    processes. A record is valid while size and mtime of the file
+    match the stored ones. WAL is used only if wal is set, see
+    SearchIndex.
+    '''
+    schema = (
+        'CREATE TABLE IF NOT EXISTS images ('
+        'path TEXT PRIMARY KEY, size INTEGER NOT NULL, '
+        'mtime INTEGER NOT NULL, mime TEXT, width INTEGER, height INTEGER, '
+        'thumbnail INTEGER NOT NULL DEFAULT 0)'
+    )
+    fields = 'mime', 'width', 'height', 'thumbnail'
+    # SQLITE_MAX_VARIABLE_NUMBER of old SQLite builds is 999
+    chunk_size = 500
+
+    def __init__(self, path, wal=False):
+        self.path = path
+        self.wal = wal
+
+    def connect(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        if self.wal:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(self.schema)
+        return conn
+
+    def get_many(self, keys):
+        ''' {path: record} for the valid records of (path, size, mtime) '''
+        keys = {x[0]: x[1:] for x in keys}
+        paths = list(keys.keys())
+        found = {}
+        if not os.path.exists(self.path):
+            return found
+        with closing(self.connect()) as conn:
+            for i in range(0, len(paths), self.chunk_size):
+                chunk = paths[i:i + self.chunk_size]
+                rows = conn.execute(
+                    'SELECT path, size, mtime, %s FROM images '
+                    'WHERE path IN (%s)' % (
+                        ', '.join(self.fields), ', '.join('?' * len(chunk))),
+                    chunk)
+                for row in rows:
+                    if tuple(row[1:3]) == keys[row[0]]:
+                        found[row[0]] = dict(zip(self.fields, row[3:]))
+        return found
+
+    def get(self, path, size, mtime):
+        return self.get_many([(path, size, mtime)]).get(path)
+
+    def put(self, path, size, mtime, **record):
+        ''' stores record, fields not given are reset '''
+        values = [record.get(x) for x in self.fields]
+        values[-1] = values[-1] or 0
+        with closing(self.connect()) as conn, conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO images (path, size, mtime, %s) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)' % ', '.join(self.fields),
+                [path, size, mtime] + values)
+
+    def remove(self, path):
+        ''' removes records of path and its descendants '''
+        if os.path.exists(self.path):
+            with closing(self.connect()) as conn, conn:
+                conn.execute(
+                    'DELETE FROM images WHERE path = ? '
+                    'OR (path >= ? AND path < ?)',
+                    (path,) + subtree_range(path))
+
+    def thumbnails(self, path):
+        ''' paths of path and its descendants having a thumbnail '''
+        if not os.path.exists(self.path):
+            return []
+        with closing(self.connect()) as conn:
+            return list(map(lambda x: x[0], conn.execute(
+                'SELECT path FROM images WHERE thumbnail = 1 AND (path = ? '
+                'OR (path >= ? AND path < ?))',
+                (path,) + subtree_range(path))))
+
+    def move(self, path, new_path):
+        ''' moves records of path and its descendants to new_path '''
+        if os.path.exists(self.path):
+            with closing(self.connect()) as conn, conn:
+                conn.execute(
+                    'UPDATE OR REPLACE images '
+                    'SET path = ? || substr(path, ?) WHERE path = ? '
+                    'OR (path >= ? AND path < ?)',
+                    (new_path, len(path) + 1, path) + subtree_range(path))
+
+    def prune(self, paths):
+        ''' removes records of all paths except given ones '''
+        if os.path.exists(self.path):
+            with closing(self.connect()) as conn, conn:
+                conn.execute('CREATE TEMP TABLE keep (path TEXT PRIMARY KEY)')
+                conn.executemany('INSERT OR IGNORE INTO keep VALUES (?)',
+                                 map(lambda x: (x,), paths))
+                conn.execute(
+                    'DELETE FROM images WHERE path NOT IN (SELECT path FROM keep)')
+
+    def reset_thumbnails(self, paths):
+        ''' marks thumbnails of paths as missing '''
+        if os.path.exists(self.path):
+            with closing(self.connect()) as conn, conn:
+                conn.executemany(
+                    'UPDATE images SET thumbnail = 0 WHERE path = ?',
+                    map(lambda x: (x,), paths))
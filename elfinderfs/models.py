@@ -16,37 +16,105 @@
 
 import base64
 import datetime
+import errno
+import itertools
+import logging
 import os
 import mimetypes
 import re
 import shutil
-
+import sqlite3
+import stat
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from functools import lru_cache
 from hashlib import md5
 from PIL import Image
 
 from django.conf import settings
 from django.contrib.sites.models import Site
 
+from .archive import ARCHIVERS
+from .cache import ListingCache
+from .fs import (
+    NodeStat, copyfile, copytree, decodes, detect_encoding, dir_access,
+    dir_sizes, has_subdirs, scandir, subdirs_cache, walk)
+from .jobs import JobQueue
+from .meta import MetaStore
+from .search import SearchIndex
+from .thumbnails import ThumbnailPool, render
+from .trash import Trash
+
 
 mimetypes.init()
 
+logger = logging.getLogger(__name__)
+
+thumbnail_pool = ThumbnailPool(
+    settings.ELFINDERFS.get('thumbnails_workers', 2))
+
+# per-request identity map of the nodes, see Node.identity_map()
+identity = threading.local()
+
+listing_cache = settings.ELFINDERFS.get('listing_cache') and ListingCache(
+    settings.ELFINDERFS['listing_cache'],
+    settings.ELFINDERFS.get('listing_cache_timeout', 3600),
+    settings.ELFINDERFS.get('listing_cache_watches', 1024))
+
 
 class AbstractNode(object):
     _root = None
     _path = None
+    _snapshot = None
+    _psnapshot = None
+    _mimetype = None
+    _metadata = None
+    _hash = None
+    _phash = None
+    _volumeid = None
 
     @staticmethod
+    @lru_cache(maxsize=65536)
     def encode(s):
         data = s.encode('utf8')
         data = base64.urlsafe_b64encode(data)
         return data.decode('utf8').rstrip('==')
 
     @staticmethod
+    @lru_cache(maxsize=65536)
     def decode(s):
         data = (s + '==').encode('utf8')
         data = base64.urlsafe_b64decode(data)
         return data.decode('utf8')
 
+    @staticmethod
+    @contextmanager
+    def identity_map():
+        '''
+        Inside the block nodes created with the same root and path are
+        the same object, so their snapshots and hashes are computed once.
+        '''
+        identity.nodes = {}
+        try:
+            yield
+        finally:
+            identity.nodes = None
+
+    def __new__(cls, hash_=None, root=None, path=None):
+        nodes = getattr(identity, 'nodes', None)
+        if nodes is None or hash_ or not (root and path):
+            return super().__new__(cls)
+        key = cls, root, os.path.normpath(path)
+        node = nodes.get(key)
+        if node is None:
+            node = nodes[key] = super().__new__(cls)
+        return node
+
     def __init__(self, hash_=None, root=None, path=None):
         '''
         Usage:
@@ -87,23 +155,141 @@ class AbstractNode(object):
     def _is_root(self):
         return self._path == os.sep
 
+    @property
+    def _stat(self):
+        ''' metadata snapshot, taken once per node '''
+        if self._snapshot is None:
+            self._snapshot = NodeStat.from_path(self._rpath)
+        return self._snapshot
+
+    @property
+    def _pstat(self):
+        ''' parent dir metadata snapshot '''
+        if self._psnapshot is None:
+            self._psnapshot = NodeStat.from_path(os.path.dirname(self._rpath))
+        return self._psnapshot
+
+    @property
+    def _paccess(self):
+        ''' dir_access() of the parent dir, shared by its child nodes '''
+        pstat = self._pstat
+        if pstat.dir_access is None:
+            pstat.dir_access = dir_access(os.path.dirname(self._rpath))
+        return pstat.dir_access
+
+    def _refresh(self):
+        ''' drop snapshots after the file/dir was modified '''
+        self._snapshot = self._psnapshot = None
+        self._mimetype = self._metadata = None
+
     @property
     def _is_dir(self):
-        return os.path.isdir(self._rpath)
+        try:
+            return self._stat.is_dir
+        except OSError:
+            return False
 
     @property
     def _parent(self):
         if not self._is_root:
             return Node(root=self._root, path=os.path.dirname(self._path))
 
-    def _listdir(self):
-        def allowed(file_):
-            path = os.path.join(self._rpath, file_)
-            return not file_.startswith('.') and not os.path.islink(path)
-        files = os.listdir(self._rpath)
-        if not settings.ELFINDERFS.get('show_hidden'):
-            files = list(filter(allowed, files))
-        return files
+    def _scandir(self):
+        return scandir(self._rpath, settings.ELFINDERFS.get('show_hidden'))
+
+    @property
+    def _skip(self):
+        ''' service files and dirs of the root, never listed in search '''
+        return {
+            os.path.normpath(os.path.join(self._config['root'],
+                                          self._config['thumbnails_prefix'])),
+            self._index.path,
+            self._staging,
+            self._trash and self._trash.path,
+        }
+
+    def _walk(self):
+        ''' (path, DirEntry list) pairs for each dir of the subtree '''
+        croot = self._config['root']
+        show_hidden = settings.ELFINDERFS.get('show_hidden')
+        for top, entries in walk(os.path.normpath(self._rpath),
+                                 show_hidden, self._skip):
+            path = os.path.normpath(
+                os.path.join(os.sep, os.path.relpath(top, croot)))
+            yield path, entries
+
+    @property
+    def _staging(self):
+        ''' staging dir of the chunked uploads '''
+        return os.path.normpath(os.path.join(
+            self._config['root'],
+            self._config.get('upload_staging', '.uploads')))
+
+    @property
+    def _trash(self):
+        ''' trash of the root, None if it's disabled '''
+        name = self._config.get('trash', '.trash')
+        if not name:
+            return None
+        root, cls = self._root, type(self)
+        return Trash.get(
+            os.path.normpath(os.path.join(self._config['root'], name)),
+            self._config.get('trash_keep', 0),
+            lambda path, rpath: cls(root=root, path=path)._purged(rpath))
+
+    @property
+    def _db_dir(self):
+        '''
+        local dir of the SQLite stores of the root, None if they are
+        kept in the root
+        '''
+        return self._config.get('db_dir')
+
+    @property
+    def _index(self):
+        ''' search index of the root '''
+        return SearchIndex(os.path.normpath(os.path.join(
+            self._db_dir or self._config['root'],
+            self._config.get('search_index', '.search.sqlite3'))),
+            wal=bool(self._db_dir))
+
+    def _children(self):
+        ''' child nodes, from the listing cache if it's enabled '''
+        if not listing_cache:
+            return list(map(self._child, self._scandir()))
+        rpath = os.path.normpath(self._rpath)
+        mtime_ns = self._stat.mtime_ns
+        entries = listing_cache.get(rpath, mtime_ns)
+        if entries is None:
+            children = list(map(self._child, self._scandir()))
+            # subdirs change without an event of the dir, they're stat'ed
+            # again, only their names are cached
+            listing_cache.set(rpath, mtime_ns, list(map(
+                lambda x: (x.name, None if x._snapshot.is_dir else
+                           x._snapshot.values()), children)))
+            return children
+        children = []
+        for name, values in entries:
+            node = Node(root=self._root, path=os.path.join(self._path, name))
+            if values is not None:
+                node._snapshot = NodeStat.from_values(values)
+            node._psnapshot = self._stat
+            children.append(node)
+        return children
+
+    def _invalidate_listing(self):
+        ''' drops cached listings of the node and its parent dir '''
+        if listing_cache:
+            rpath = os.path.normpath(self._rpath)
+            listing_cache.invalidate(rpath)
+            listing_cache.invalidate(os.path.dirname(rpath))
+
+    def _child(self, entry):
+        ''' child node prefilled with DirEntry metadata '''
+        node = Node(root=self._root, path=os.path.join(self._path, entry.name))
+        node._snapshot = NodeStat.from_entry(entry)
+        node._psnapshot = self._stat
+        return node
 
 
 class InfoNode(AbstractNode):
@@ -121,27 +307,36 @@ class InfoNode(AbstractNode):
         Hash of current file/dir path, first symbol must be letter,
         symbols before _underline_ - volume id
         '''
-        return '%s%s' % (
-            self.volumeid,
-            Node.encode(self._path))
+        if self._hash is None:
+            self._hash = '%s%s' % (
+                self.volumeid,
+                Node.encode(self._path))
+        return self._hash
 
     @property
     def phash(self):
         ''' Hash of parent directory. Required except roots dirs '''
-        return self._parent and self._parent.hash
+        if self._phash is None and not self._is_root:
+            self._phash = '%s%s' % (
+                self.volumeid,
+                Node.encode(os.path.dirname(self._path)))
+        return self._phash
 
     @property
     def mime(self):
         ''' mime type '''
-        if os.path.isdir(self._rpath):
-            return 'directory'
-        else:
-            return mimetypes.guess_type(self._rpath)[0] or 'file'
+        if self._mimetype is None:
+            if self._stat.is_dir:
+                self._mimetype = 'directory'
+            else:
+                self._mimetype = (
+                    mimetypes.guess_type(self._rpath)[0] or 'file')
+        return self._mimetype
 
     @property
     def ts(self):
         ''' File modification time in unix timestamp '''
-        return int(os.path.getmtime(self._rpath))
+        return int(self._stat.mtime)
 
     @property
     def date(self):
@@ -153,8 +348,8 @@ class InfoNode(AbstractNode):
 
     @property
     def size(self):
-        ''' File size in bytes '''
-        return os.path.getsize(self._rpath)
+        ''' File size in bytes, 0 for dirs '''
+        return 0 if self._stat.is_dir else self._stat.size
 
     @property
     def dirs(self):
@@ -166,27 +361,28 @@ class InfoNode(AbstractNode):
         if not self._is_dir:
             return 0
         try:
-            children = map(lambda x: os.path.join(self._rpath, x), self._listdir())
+            show_hidden = settings.ELFINDERFS.get('show_hidden')
+            found = subdirs_cache.get(
+                (self._rpath, bool(show_hidden)), self._stat.mtime_ns,
+                lambda: has_subdirs(self._rpath, show_hidden))
         except OSError:
             return 0
         else:
-            return 1 if any(map(os.path.isdir, children)) else 0
+            return 1 if found else 0
 
     @property
     def read(self):
         ''' Is readable '''
-        condition = os.access(self._rpath, os.R_OK)
-        if self._is_dir:
-            condition = condition and os.access(self._rpath, os.X_OK)
-        return 1 if condition else 0
+        mask = os.R_OK | os.X_OK if self._stat.is_dir else os.R_OK
+        return 1 if self._stat.access(mask) else 0
 
     @property
     def write(self):
         ''' Is writable '''
-        condition = os.access(self._rpath, os.W_OK)
-        if self._is_dir:
-            condition = condition and os.access(self._rpath, os.X_OK)
-        return 1 if condition else 0
+        mask = os.W_OK | os.X_OK if self._stat.is_dir else os.W_OK
+        # mode bits are checked per node, the mount per dir
+        return 1 if (self._stat.access(mask) and
+                     not self._paccess[1]) else 0
 
     @property
     def locked(self):
@@ -194,7 +390,7 @@ class InfoNode(AbstractNode):
         Is file locked. If locked that object cannot be deleted,
         renamed or moved
         '''
-        return 0 if os.access(os.path.dirname(self._rpath), os.W_OK) else 1
+        return 0 if self._paccess[0] else 1
 
     @property
     def tmb(self):
@@ -222,7 +418,9 @@ class InfoNode(AbstractNode):
     @property
     def volumeid(self):
         ''' Volume id. For root dir only. '''
-        return Node.encode(self._root) + '_'
+        if self._volumeid is None:
+            self._volumeid = Node.encode(self._root) + '_'
+        return self._volumeid
 
 
 class ManagedNode(InfoNode):
@@ -232,20 +430,82 @@ class ManagedNode(InfoNode):
                    settings.ELFINDERFS['roots'].items())
 
     @staticmethod
-    def search(q):
-        found = []
-        for root in Node.roots():
-            for parent, dirs, files in os.walk(root._rpath):
-                for i in dirs + files:
-                    if q in i:
-                        rpath = os.path.join(parent, i)
-                        path = os.path.relpath(rpath, root._rpath)
-                        node = Node(root=root._root, path=path)
+    def search(q, target=None):
+        '''
+        Searches target subtree or all roots in parallel. Indexed roots
+        are looked up in the index, others are walked until search_limit
+        results are found or search_timeout seconds pass.
+        '''
+        limit = settings.ELFINDERFS.get('search_limit', 1000)
+        timeout = settings.ELFINDERFS.get('search_timeout', 10)
+        deadline = time.monotonic() + timeout
+        lock = threading.Lock()
+        count = [0]
+
+        def scan(top):
+            index = top._index
+            if index.exists():
+                found, stale = [], []
+                for path in index.search(q, top._path, limit):
+                    node = Node(root=top._root, path=path)
+                    (found if node.exists() else stale).append(node)
+                for node in stale:
+                    # removed outside of the elFinder
+                    node.remove_from_index()
+                return found
+            found = []
+            for path, entries in top._walk():
+                if count[0] >= limit or time.monotonic() > deadline:
+                    break
+                for entry in entries:
+                    if q in entry.name:
+                        node = Node(root=top._root,
+                                    path=os.path.join(path, entry.name))
+                        node._snapshot = NodeStat.from_entry(entry)
                         found.append(node)
-        return found
+                        with lock:
+                            count[0] += 1
+                        if count[0] >= limit:
+                            break
+            return found
+
+        tops = [target] if target else list(Node.roots())
+        with ThreadPoolExecutor(max_workers=len(tops)) as executor:
+            found = sum(executor.map(scan, tops), [])
+        return found[:limit]
+
+    def build_index(self):
+        ''' (re)builds search index of the root, returns entries count '''
+        def entries():
+            for path, children in self._walk():
+                for child in children:
+                    yield os.path.join(path, child.name), child.name
+        return self._index.build(entries())
+
+    def add_to_index(self):
+        ''' adds node with its subtree to the search index if any '''
+        index = self._index
+        if index.exists() and not self._is_root:
+            entries = [(self._path, self.name)]
+            if self._is_dir:
+                for path, children in self._walk():
+                    entries += map(
+                        lambda x: (os.path.join(path, x.name), x.name),
+                        children)
+            index.add(entries)
+
+    def remove_from_index(self):
+        ''' removes node with its subtree from the search index if any '''
+        index = self._index
+        if index.exists():
+            index.remove(self._path)
 
     def exists(self):
-        return os.path.exists(self._rpath)
+        try:
+            self._stat
+        except OSError:
+            return False
+        return True
 
     def files(self, root=True, tree=False):
         files = []
@@ -253,18 +513,63 @@ class ManagedNode(InfoNode):
             for root in Node.roots():
                 files += root.files(root=False, tree=True)
         else:
-            files = list(map(lambda x: Node(root=self._root,
-                                            path=os.path.join(self._path, x)),
-                             self._listdir()))
+            files = self._children()
             if tree:
                 files.append(self)
         return files
 
+    def subdirs(self, root=True, tree=False):
+        '''
+        Same as files() but dirs only, used by the navigation tree.
+        File entries are skipped without any stat calls.
+        '''
+        dirs = []
+        if self._is_root and root:
+            for root in Node.roots():
+                dirs += root.subdirs(root=False, tree=True)
+        else:
+            dirs = list(map(self._child,
+                            filter(lambda x: x.is_dir(), self._scandir())))
+            if tree:
+                dirs.append(self)
+        return dirs
+
+    @staticmethod
+    def total_size(nodes, limit=None):
+        '''
+        total size of the nodes, dirs are counted recursively,
+        counting stops once the total exceeds limit
+        '''
+        dirs = [x._rpath for x in nodes if x._is_dir]
+        files = sum(x.size for x in nodes if not x._is_dir)
+        if limit is not None:
+            if files > limit:
+                return files
+            limit -= files
+        return files + dir_sizes.size(
+            dirs, settings.ELFINDERFS.get('show_hidden'),
+            settings.ELFINDERFS.get('size_workers', 8), limit)
+
+    def ls(self, intersect=None):
+        '''
+        Names of the dir entries from a single scandir pass, without
+        building nodes. If intersect is given, returns {hash: name}
+        of the entries with the names listed in it.
+        '''
+        names = map(lambda x: x.name, self._scandir())
+        if intersect is None:
+            return list(names)
+        intersect = set(intersect)
+        return dict(map(
+            lambda x: (Node(root=self._root,
+                            path=os.path.join(self._path, x)).hash, x),
+            filter(lambda x: x in intersect, names)))
+
     def parents(self):
         files = []
         node = self
         while node:
-            files += node.files(tree=True)
+            files += node.subdirs(tree=True)
             node = node._parent
         return files
 
@@ -278,6 +583,51 @@ class ManagedNode(InfoNode):
     def open(self, mode='rb'):
         return open(self._rpath, mode)
 
+    def _encoding(self):
+        '''
+        text encoding guessed from the start of the file, UTF-8 is
+        checked till the end, a valid start may be followed by other
+        bytes
+        '''
+        fallback = settings.ELFINDERFS.get('edit_encoding', 'latin-1')
+        with self.open() as f:
+            encoding = detect_encoding(f.read(64 * 1024), fallback)
+            if encoding == 'utf-8':
+                f.seek(0)
+                if not decodes(f, encoding):
+                    return fallback
+        return encoding
+
+    def read_text(self):
+        with open(self._rpath, encoding=self._encoding(), newline='') as f:
+            return f.read()
+
+    def write_text(self, content, block_size=64 * 1024):
+        '''
+        Writes content to a temporary file in blocks and renames it
+        over the file, so a failure never leaves it truncated.
+        The encoding of the file is kept if the content fits it.
+        '''
+        def write(encoding):
+            with open(tmp, 'w', encoding=encoding) as f:
+                for i in range(0, len(content), block_size):
+                    f.write(content[i:i + block_size])
+
+        fd, tmp = tempfile.mkstemp(prefix='.', suffix='.put',
+                                   dir=os.path.dirname(self._rpath))
+        os.close(fd)
+        try:
+            try:
+                write(self._encoding())
+            except UnicodeEncodeError:
+                write('utf-8')
+            os.chmod(tmp, stat.S_IMODE(self._stat.mode))
+            os.replace(tmp, self._rpath)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        self._refresh()
+
     def mkdir(self, name):
         new_path = os.path.join(self._path, name)
         new_rpath = os.path.join(self._rpath, name)
@@ -291,18 +641,123 @@ class ManagedNode(InfoNode):
         f.close()
         return Node(root=self._root, path=new_path)
 
+    def save_upload(self, upload):
+        '''
+        Saves UploadedFile into the dir. Uploads spooled to disk by
+        Django are renamed into place when they are on the same
+        filesystem, others are written in chunks to a temporary file
+        first, so a failed upload never leaves a truncated file.
+        '''
+        name = os.path.basename(upload.name)
+        new_path = os.path.join(self._path, name)
+        new_rpath = os.path.join(self._rpath, name)
+        permissions = settings.FILE_UPLOAD_PERMISSIONS or 0o644
+        if hasattr(upload, 'temporary_file_path'):
+            try:
+                os.rename(upload.temporary_file_path(), new_rpath)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+            else:
+                os.chmod(new_rpath, permissions)
+                return Node(root=self._root, path=new_path)
+        fd, tmp = tempfile.mkstemp(prefix='.', suffix='.upload',
+                                   dir=self._rpath)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in upload.chunks():
+                    f.write(chunk)
+            os.chmod(tmp, permissions)
+            os.replace(tmp, new_rpath)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        return Node(root=self._root, path=new_path)
+
+    def _expire_chunks(self):
+        ''' removes partial uploads which were not touched for a while '''
+        expire = settings.ELFINDERFS.get('upload_expire', 24 * 60 * 60)
+        for entry in scandir(self._staging, show_hidden=True):
+            try:
+                if entry.stat().st_mtime < time.time() - expire:
+                    if entry.is_dir():
+                        shutil.rmtree(entry.path, ignore_errors=True)
+                    else:
+                        os.remove(entry.path)
+            except FileNotFoundError:
+                # removed by a concurrent request
+                pass
+
+    def write_chunk(self, upload, name, cid, index, total, start):
+        '''
+        Stores a part of the chunked upload into the staging dir of
+        the root. Parts are written at their offsets of a single file,
+        so resent parts just overwrite themselves. Returns merged file
+        id when all the parts are received.
+        '''
+        chunk_id = md5(('%s:%s:%s' % (self._path, cid, name))
+                       .encode('utf-8')).hexdigest()
+        chunk_dir = os.path.join(self._staging, chunk_id)
+        if index == 0 and os.path.isdir(self._staging):
+            self._expire_chunks()
+        os.makedirs(chunk_dir, exist_ok=True)
+
+        data = os.path.join(chunk_dir, 'data')
+        fd = os.open(data, os.O_WRONLY | os.O_CREAT, 0o644)
+        with os.fdopen(fd, 'wb') as f:
+            f.seek(start)
+            for chunk in upload.chunks():
+                f.write(chunk)
+        open(os.path.join(chunk_dir, '%s.part' % index), 'w').close()
+
+        parts = len(list(filter(lambda x: x.endswith('.part'),
+                                os.listdir(chunk_dir))))
+        if parts >= total:
+            try:
+                # not the chunk_dir path itself, it's still there
+                os.rename(data, os.path.join(self._staging,
+                                             chunk_id + '.merged'))
+            except FileNotFoundError:
+                # merged by a concurrent request
+                return None
+            shutil.rmtree(chunk_dir, ignore_errors=True)
+            return chunk_id
+
+    def merge_chunks(self, chunk_id, name):
+        ''' moves merged chunked upload into the dir '''
+        if not re.match(r'^[0-9a-f]{32}$', chunk_id):
+            raise FileNotFoundError(chunk_id)
+        name = os.path.basename(name)
+        new_path = os.path.join(self._path, name)
+        new_rpath = os.path.join(self._rpath, name)
+        shutil.move(os.path.join(self._staging, chunk_id + '.merged'),
+                    new_rpath)
+        return Node(root=self._root, path=new_path)
+
     def rename(self, name):
         new_path = os.path.join(os.path.dirname(self._path), name)
         new_rpath = os.path.join(os.path.dirname(self._rpath), name)
         os.rename(self._rpath, new_rpath)
         return Node(root=self._root, path=new_path)
 
+    def _remove(self):
+        if self._is_dir:
+            shutil.rmtree(self._rpath)
+        else:
+            os.remove(self._rpath)
+
     def delete(self):
+        '''
+        Moves the node into the trash of the root, it's removed in
+        background. Nodes on other filesystems are removed in place.
+        '''
         if self._rpath != os.sep:
-            if os.path.isdir(self._rpath):
-                shutil.rmtree(self._rpath)
-            else:
-                os.remove(self._rpath)
+            trash = self._trash
+            if trash is None or not trash.put(self._rpath, self._path):
+                self._remove()
+
+    def _purged(self, rpath):
+        ''' called by the trash before rpath, the deleted node, is removed '''
 
     def duplicate(self):
         if not self._is_root:
@@ -318,95 +773,531 @@ class ManagedNode(InfoNode):
                     new_name = '%s.%s' % (new_name, ext)
                 return new_name
 
+            # one listing instead of a stat per taken name
+            taken = set(map(lambda x: x.name, scandir(
+                os.path.dirname(self._rpath), show_hidden=True)))
             i = 1
-            while os.path.exists(os.path.join(os.path.dirname(self._rpath),
-                                              get_name(name, i))):
+            while get_name(name, i) in taken:
                 i += 1
             new_name = get_name(name, i)
             new_path = os.path.join(os.path.dirname(self._path), new_name)
             new_rpath = os.path.join(os.path.dirname(self._rpath), new_name)
             if self._is_dir:
-                shutil.copytree(self._rpath, new_rpath)
+                copytree(self._rpath, new_rpath,
+                         settings.ELFINDERFS.get('copy_workers', 8))
             else:
-                shutil.copyfile(self._rpath, new_rpath)
+                copyfile(self._rpath, new_rpath)
             return Node(root=self._root, path=new_path)
 
     def copy(self, dst_node, cut=False):
         if not self._is_root:
             new_path = os.path.join(dst_node._path, self.name)
             new_rpath = os.path.join(dst_node._rpath, self.name)
+            if cut and self._stat.dev == dst_node._stat.dev:
+                # same filesystem, moving is just a rename
+                try:
+                    os.rename(self._rpath, new_rpath)
+                except OSError as e:
+                    # e.g. different mount points of the same device
+                    if e.errno != errno.EXDEV:
+                        raise
+                else:
+                    return Node(root=dst_node._root, path=new_path)
             if self._is_dir:
-                shutil.copytree(self._rpath, new_rpath)
+                copytree(self._rpath, new_rpath,
+                         settings.ELFINDERFS.get('copy_workers', 8))
                 if cut:
                     shutil.rmtree(self._rpath, ignore_errors=False)
             else:
-                shutil.copyfile(self._rpath, new_rpath)
+                copyfile(self._rpath, new_rpath)
                 if cut:
                     os.remove(self._rpath)
             return Node(root=dst_node._root, path=new_path)
 
+    def archive(self, targets, mime, name=None):
+        '''
+        Packs the targets into a new archive in the dir. It's written
+        straight into a temporary file next to it, which is renamed when
+        it's complete. Data is compressed in archive_workers threads.
+        '''
+        ext, write = ARCHIVERS[mime]
+        if name:
+            base = os.path.basename(name)
+            if base.endswith(ext):
+                base = base[:-len(ext)]
+        else:
+            base = targets[0].name if len(targets) == 1 else 'Archive'
+        taken = set(map(lambda x: x.name,
+                        scandir(self._rpath, show_hidden=True)))
+        new_name = base + ext
+        i = 1
+        while new_name in taken:
+            new_name = '%s copy %s%s' % (base, i, ext)
+            i += 1
+
+        def members():
+            for target in targets:
+                yield target._rpath, target.name
+                if not target._is_dir:
+                    continue
+                for path, entries in target._walk():
+                    for entry in entries:
+                        if entry.is_symlink():
+                            continue
+                        yield entry.path, os.path.join(
+                            target.name, os.path.relpath(
+                                os.path.join(path, entry.name), target._path))
+
+        new_rpath = os.path.join(self._rpath, new_name)
+        fd, tmp = tempfile.mkstemp(prefix='.', suffix='.archive',
+                                   dir=self._rpath)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f, members(), settings.ELFINDERFS.get(
+                    'archive_workers', os.cpu_count() or 1))
+            os.chmod(tmp, settings.FILE_UPLOAD_PERMISSIONS or 0o644)
+            os.replace(tmp, new_rpath)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        return Node(root=self._root, path=os.path.join(self._path, new_name))
+
+    @staticmethod
+    def track_changes(added=(), removed=(), changed=()):
+        '''
+        keeps search indexes and listing cache in sync with
+        modifying commands
+        '''
+        for node in itertools.chain(added, removed, changed):
+            node._invalidate_listing()
+        for node in itertools.chain(added, changed):
+            # the same node object may be shared since the request start
+            node._refresh()
+        try:
+            for node in removed:
+                node.remove_from_index()
+            for node in added:
+                node.add_to_index()
+        except sqlite3.Error:
+            # files are already changed, the index is fixed by a rebuild
+            logger.exception('search index update failed')
+
+    @staticmethod
+    def batch(cmd, targets, progress=None, **params):
+        '''
+        Runs rm, duplicate, paste, resize or archive command over the
+        targets, returns added, removed and changed nodes. progress(done)
+        is called after each target.
+        '''
+        if cmd == 'archive':
+            # a single archive of all the targets
+            added = [params['dst'].archive(
+                targets, params['type'], params.get('name'))]
+            if progress:
+                progress(len(targets))
+            return {'added': added, 'removed': [], 'changed': []}
+        added, removed, changed = [], [], []
+        for i, target in enumerate(targets):
+            if cmd == 'rm':
+                target.delete()
+                removed.append(target)
+            elif cmd == 'duplicate':
+                added.append(target.duplicate())
+            elif cmd == 'paste':
+                added.append(target.copy(params['dst'], cut=params.get('cut')))
+                if params.get('cut'):
+                    removed.append(target)
+            elif cmd == 'resize':
+                target.resize(**params)
+                changed.append(target)
+            if progress:
+                progress(i + 1)
+        return {'added': added, 'removed': removed, 'changed': changed}
+
 
 class ImageNodeMixin(object):
+    image_mimes = (
+        'image/jpeg', 'image/png', 'image/gif',
+        'image/vnd.microsoft.icon', 'image/x-icon')
+
     @property
     def _is_image(self):
-        return self.mime in (
-            'image/jpeg', 'image/png', 'image/gif',
-            'image/vnd.microsoft.icon')
+        '''
+        Guessed by the extension, the mime sniffed by _dimensions
+        overrides it, so a misnamed file is not rendered again and again
+        '''
+        if self.mime not in self.image_mimes:
+            return False
+        mime = self._meta.get('mime')
+        return mime is None or mime in self.image_mimes
+
+    @property
+    def _max_pixels(self):
+        ''' images are decoded in memory, so their size is limited '''
+        return settings.ELFINDERFS.get('max_image_pixels', 50000000)
+
+    @property
+    def _troot(self):
+        ''' thumbnails dir '''
+        return os.path.join(self._config['root'],
+                            self._config['thumbnails_prefix'])
+
+    @property
+    def _tfile(self):
+        ''' thumbnail file name '''
+        return md5(self.hash.encode('utf-8')).hexdigest() + '.png'
+
+    @property
+    def _meta_store(self):
+        return MetaStore(os.path.join(self._db_dir or self._troot,
+                                      'meta.sqlite3'), wal=bool(self._db_dir))
+
+    @property
+    def _meta(self):
+        ''' image metadata record, looked up once per node '''
+        if self._metadata is None:
+            st = self._stat
+            self._metadata = self._meta_store.get(
+                self._path, st.size, st.mtime_ns) or {}
+        return self._metadata
+
+    def _update_meta(self, **record):
+        meta = dict(self._meta, **record)
+        st = self._stat
+        self._meta_store.put(self._path, st.size, st.mtime_ns, **meta)
+        self._metadata = meta
+
+    @staticmethod
+    def _prefetch_meta(nodes):
+        ''' looks up metadata of the image nodes with a query per root '''
+        roots = {}
+        for node in nodes:
+            if node._metadata is None and node.mime in node.image_mimes:
+                roots.setdefault(node._root, []).append(node)
+        for root_nodes in roots.values():
+            found = root_nodes[0]._meta_store.get_many(map(
+                lambda x: (x._path, x._stat.size, x._stat.mtime_ns),
+                root_nodes))
+            for node in root_nodes:
+                node._metadata = found.get(node._path, {})
+
+    def files(self, *args, **kwargs):
+        files = super().files(*args, **kwargs)
+        self._prefetch_meta(files)
+        return files
 
     def _get_thumbnail(self, force_update=False):
-        troot = os.path.join(self._config['root'],
-                             self._config['thumbnails_prefix'])
+        ''' renders missing thumbnail, returns None if rendering failed '''
+        if self._thumbnail_failed and not force_update:
+            return None
+        troot = self._troot
         if not os.path.exists(troot):
             os.mkdir(troot)
 
-        tfile = md5(self.hash.encode('utf-8')).hexdigest() + '.png'
+        tfile = self._tfile
         tpath = os.path.join(troot, tfile)
 
-        if not os.path.exists(tpath) or force_update:
-            image = Image.open(self._rpath)
-            size = (50, 50)
-            image.thumbnail(size, Image.ANTIALIAS)
-            thumbnail = Image.new('RGBA', size, (255, 255, 255, 0))
-            thumbnail.paste(image, (
-                int((size[0] - image.size[0]) / 2),
-                int((size[1] - image.size[1]) / 2)))
-            thumbnail.save(tpath)
+        if force_update or not self._thumbnail_fresh(tpath):
+            try:
+                render(self._rpath, tpath, max_pixels=self._max_pixels)
+            except Exception:
+                logger.warning('thumbnail of %s failed', self._rpath,
+                               exc_info=True)
+                self._update_meta(thumbnail=-1)
+                return None
+            self._update_meta(thumbnail=1)
         return tfile
 
+    @property
+    def _thumbnail_failed(self):
+        '''
+        rendering failed (corrupt or too big image), it's not tried
+        again until the image is changed
+        '''
+        return self._meta.get('thumbnail') == -1
+
+    def _thumbnail_done(self, future):
+        ''' records the result of the render queued in the pool '''
+        error = future.exception()
+        # a crashed pool fails all the queued renders, not only the bad one
+        if not isinstance(error, BrokenProcessPool):
+            self._update_meta(thumbnail=-1 if error else 1)
+
+    def _thumbnail_fresh(self, tpath):
+        ''' thumbnail exists and it's not older than the image '''
+        try:
+            return os.stat(tpath).st_mtime_ns >= self._stat.mtime_ns
+        except FileNotFoundError:
+            return False
+
+    def _queue_thumbnail(self):
+        '''
+        Queues rendering of the missing thumbnail in the thumbnails pool.
+        Returns future or None if thumbnail is ready or failed.
+        '''
+        if self._meta.get('thumbnail'):
+            return None
+        tpath = os.path.join(self._troot, self._tfile)
+        if self._thumbnail_fresh(tpath):
+            self._update_meta(thumbnail=1)
+        else:
+            os.makedirs(self._troot, exist_ok=True)
+            future = thumbnail_pool.submit(self._rpath, tpath,
+                                           max_pixels=self._max_pixels)
+            # renames and moves find the thumbnails in the store
+            future.add_done_callback(self._thumbnail_done)
+            return future
+
     @property
     def _tpath(self):
         ''' thumbnail path '''
         return self._get_thumbnail()
 
+    @property
+    def _tmb_url(self):
+        path = os.path.join(self._config['thumbnails_prefix'], self._tfile)
+        return self._config['url'] + path
+
     @property
     def tmb(self):
-        if self._is_image:
-            path = os.path.join(self._config['thumbnails_prefix'],
-                                self._tpath)
-            return self._config['url'] + path
+        '''
+        Thumbnail url. Thumbnails are rendered in background if
+        thumbnails_workers is set, meanwhile it's 1.
+        '''
+        if self._is_image and not self._thumbnail_failed:
+            if not thumbnail_pool.workers:
+                if self._get_thumbnail() is None:
+                    return None
+            elif self._queue_thumbnail():
+                return 1
+            return self._tmb_url
+
+    @staticmethod
+    def thumbnails(nodes):
+        '''
+        Renders missing thumbnails of the nodes in parallel.
+        Returns {hash: thumbnail url} for the rendered ones.
+        '''
+        nodes = list(filter(
+            lambda x: x._is_image and not x._thumbnail_failed, nodes))
+        futures = {}
+        for node in nodes:
+            if not thumbnail_pool.workers:
+                node._get_thumbnail()
+            else:
+                future = node._queue_thumbnail()
+                if future:
+                    futures[node.hash] = future
+        wait(futures.values(),
+             timeout=settings.ELFINDERFS.get('thumbnails_timeout', 30))
+        images = {}
+        for node in nodes:
+            future = futures.get(node.hash)
+            if future is None:
+                ready = not node._thumbnail_failed
+            else:
+                ready = future.done() and not future.exception()
+            if ready:
+                images[node.hash] = node._tmb_url
+        return images
+
+    @property
+    def _dimensions(self):
+        '''
+        (width, height) of the image, only the header is read.
+        None if Pillow can't read it.
+        '''
+        meta = self._meta
+        if meta.get('mime') == '':
+            return None
+        if meta.get('width') is None:
+            try:
+                image = Image.open(self._rpath)
+            except OSError:
+                # corrupt or not an image, _is_image skips it from now on
+                self._update_meta(mime='')
+                return None
+            self._update_meta(mime=Image.MIME.get(image.format),
+                              width=image.size[0], height=image.size[1])
+            meta = self._meta
+        return meta['width'], meta['height']
 
     @property
     def dim(self):
         if self._is_image:
-            image = Image.open(self._rpath)
-            return '%sx%s' % image.size
+            dimensions = self._dimensions
+            if dimensions:
+                return '%sx%s' % dimensions
+
+    def _images(self):
+        ''' image nodes of the subtree, the node itself for files '''
+        if not self._is_dir:
+            return [self] if self._is_image else []
+        images = []
+        for path, entries in self._walk():
+            for entry in entries:
+                mime = mimetypes.guess_type(entry.name)[0]
+                if (mime in self.image_mimes and
+                        not entry.is_dir(follow_symlinks=False)):
+                    images.append(Node(root=self._root,
+                                       path=os.path.join(path, entry.name)))
+        return images
+
+    def _thumbnailed(self):
+        '''
+        image nodes of the subtree having a thumbnail, looked up in
+        the metadata store instead of walking the subtree
+        '''
+        return list(map(lambda x: Node(root=self._root, path=x),
+                        self._meta_store.thumbnails(self._path)))
+
+    def _move_thumbnails(self, images, dst_node):
+        ''' moves thumbnails of the images after node was moved '''
+        if images:
+            os.makedirs(dst_node._troot, exist_ok=True)
+        for image in images:
+            new_image = Node(root=dst_node._root,
+                             path=dst_node._path + image._path[len(self._path):])
+            try:
+                os.replace(os.path.join(image._troot, image._tfile),
+                           os.path.join(new_image._troot, new_image._tfile))
+            except OSError:
+                # it will be rendered again
+                pass
+        if dst_node._root == self._root:
+            self._meta_store.move(self._path, dst_node._path)
+        else:
+            self._meta_store.remove(self._path)
+
+    def _delete_thumbnails(self, images):
+        for image in images:
+            try:
+                os.remove(os.path.join(image._troot, image._tfile))
+            except FileNotFoundError:
+                pass
+        self._meta_store.remove(self._path)
+
+    def _remove(self):
+        images = self._images()
+        super()._remove()
+        self._delete_thumbnails(images)
+
+    def _purged(self, rpath):
+        if os.path.lexists(self._rpath):
+            # a new node took the path, thumbnails are its own
+            return
+        if not os.path.isdir(rpath) or os.path.islink(rpath):
+            names = [(self._path, self.name)]
+        else:
+            names = []
+            for top, entries in walk(
+                    rpath, settings.ELFINDERFS.get('show_hidden')):
+                path = os.path.join(self._path, os.path.relpath(top, rpath))
+                names += map(lambda x: (os.path.join(path, x.name), x.name),
+                             filter(lambda x: not x.is_dir(
+                                 follow_symlinks=False), entries))
+        self._delete_thumbnails(list(map(
+            lambda x: Node(root=self._root, path=os.path.normpath(x[0])),
+            filter(lambda x: mimetypes.guess_type(x[1])[0] in
+                   self.image_mimes, names))))
+
+    def rename(self, name):
+        images = self._thumbnailed()
+        node = super().rename(name)
+        self._move_thumbnails(images, node)
+        return node
+
+    def copy(self, dst_node, cut=False):
+        images = self._thumbnailed() if cut else []
+        node = super().copy(dst_node, cut=cut)
+        if node and cut:
+            self._move_thumbnails(images, node)
+        return node
+
+    def collect_thumbnails(self):
+        '''
+        Removes orphaned thumbnails of the root and evicts least recently
+        used ones above thumbnails_max_size bytes. Returns removed count.
+        '''
+        if not os.path.isdir(self._troot):
+            return 0
+        expected = dict(map(lambda x: (x._tfile, x._path), self._images()))
+        removed = 0
+        thumbnails = []
+        for entry in scandir(self._troot, show_hidden=True):
+            if '.sqlite3' in entry.name:
+                # the metadata store and the jobs of the default root
+                # with their journals
+                continue
+            st = entry.stat()
+            if entry.name in expected:
+                # atime is the best guess of the last use available,
+                # thumbnails are served by the web server
+                thumbnails.append(
+                    (max(st.st_atime, st.st_mtime), st.st_size, entry.name))
+            elif (not entry.name.endswith('.tmp') or
+                    st.st_mtime < time.time() - 3600):
+                os.remove(entry.path)
+                removed += 1
+        self._meta_store.prune(expected.values())
+
+        budget = self._config.get('thumbnails_max_size')
+        if budget:
+            total = sum(map(lambda x: x[1], thumbnails))
+            evicted = []
+            for used, size, name in sorted(thumbnails):
+                if total <= budget:
+                    break
+                os.remove(os.path.join(self._troot, name))
+                total -= size
+                evicted.append(expected[name])
+            self._meta_store.reset_thumbnails(evicted)
+            removed += len(evicted)
+        return removed
 
     def resize(self, width, height, x=0, y=0, mode='resize'):
         image = Image.open(self._rpath)
         new_image = image
         if mode == 'resize':
+            # JPEG downscaling doesn't need full resolution decoding
+            image.draft(image.mode, (width, height))
             new_image = image.resize((width, height), Image.ANTIALIAS)
-            self._get_thumbnail(force_update=True)
         elif mode == 'crop':
             new_image = image.crop((x, y, width + x, height + y))
-            self._get_thumbnail(force_update=True)
         new_image.save(self._rpath)
+        self._refresh()
+        self._get_thumbnail(force_update=True)
 
 
 class Node(ImageNodeMixin, ManagedNode):
     ''' Virtual model which represents file/dir. '''
 
 
+# jobs are kept next to the SQLite stores of the default root, so
+# projects on the same host don't share them
+default_node = Node()
+job_queue = settings.ELFINDERFS.get('jobs_threshold') is not None and JobQueue(
+    settings.ELFINDERFS.get('jobs_db', os.path.join(
+        default_node._db_dir or default_node._troot, 'jobs.sqlite3')),
+    settings.ELFINDERFS.get('jobs_workers', 2),
+    settings.ELFINDERFS.get('jobs_keep', 86400),
+    wal='jobs_db' in settings.ELFINDERFS or bool(default_node._db_dir))
+
+
+def run_batch(cmd, hashes, params, progress=None):
+    '''
+    Node.batch() task of the background jobs, nodes are passed
+    and returned by hashes.
+    '''
+    if 'dst' in params:
+        params['dst'] = Node(hash_=params['dst'])
+    result = Node.batch(cmd, list(map(lambda x: Node(hash_=x), hashes)),
+                        progress, **params)
+    Node.track_changes(**result)
+    return dict(map(lambda x: (x[0], list(map(lambda y: y.hash, x[1]))),
+                    result.items()))
+
+
 class SiteFiles(Site):
     class Meta(object):
         proxy = True
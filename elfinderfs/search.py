@@ -0,0 +1,142 @@
+# Copyright (C) 2014 Okami, okami@fuzetsu.info
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+import os
+import re
+import sqlite3
+import tempfile
+
+from contextlib import closing
+
+from .fs import subtree_range
+
+
+class SearchIndex(object):
+    '''
+    Optional per-root search index. It's a SQLite database with
+    a trigram FTS5 table over file names. Paths are stored in the same
+    form as Node._path. If FTS5 is not available names are matched
+    with a plain table scan, which still avoids walking the filesystem.
+
+    WAL needs shared memory, which network filesystems don't provide,
+    so it's used only if wal is set, e.g. for an index on a local disk.
+    Otherwise SQLite keeps its default rollback journal.
+    '''
+    schema = (
+        'CREATE TABLE entries ('
+        'id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL, '
+        'name TEXT NOT NULL)',
+    )
+    fts_schema = (
+        "CREATE VIRTUAL TABLE names USING fts5("
+        "name, content='entries', content_rowid='id', "
+        "tokenize='trigram case_sensitive 1')",
+        "INSERT INTO names (names) VALUES ('rebuild')",
+        'CREATE TRIGGER entries_ai AFTER INSERT ON entries BEGIN '
+        'INSERT INTO names (rowid, name) VALUES (new.id, new.name); END',
+        'CREATE TRIGGER entries_ad AFTER DELETE ON entries BEGIN '
+        "INSERT INTO names (names, rowid, name) "
+        "VALUES ('delete', old.id, old.name); END",
+    )
+
+    def __init__(self, path, wal=False):
+        self.path = path
+        self.wal = wal
+
+    @staticmethod
+    def _pattern(q):
+        ''' case sensitive substring match, like "q in name" '''
+        return '*%s*' % re.sub(r'([*?[])', r'[\1]', q)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        if self.wal:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _has_fts(self, conn):
+        return conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' "
+            "AND name = 'names'").fetchone() is not None
+
+    def build(self, entries):
+        '''
+        Recreates index from (path, name) pairs. It's built in a temporary
+        database without locking the index, then copied over the index
+        with the backup API in a single short write transaction, which is
+        safe for open connections unlike replacing the file.
+        '''
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix='elfinderfs-', suffix='.sqlite3')
+        os.close(fd)
+        try:
+            with closing(sqlite3.connect(tmp)) as conn:
+                conn.execute('PRAGMA journal_mode=OFF')
+                conn.execute('PRAGMA synchronous=OFF')
+                for statement in self.schema:
+                    conn.execute(statement)
+                conn.executemany(
+                    'INSERT OR IGNORE INTO entries (path, name) VALUES (?, ?)',
+                    entries)
+                conn.commit()
+                try:
+                    for statement in self.fts_schema:
+                        conn.execute(statement)
+                    conn.commit()
+                except sqlite3.OperationalError:
+                    # no FTS5 or trigram tokenizer in this SQLite build
+                    conn.rollback()
+                with closing(self.connect()) as dst:
+                    conn.backup(dst)
+                return conn.execute(
+                    'SELECT COUNT(*) FROM entries').fetchone()[0]
+        finally:
+            os.remove(tmp)
+
+    def add(self, entries):
+        ''' adds (path, name) pairs '''
+        with closing(self.connect()) as conn, conn:
+            conn.executemany(
+                'INSERT OR IGNORE INTO entries (path, name) VALUES (?, ?)',
+                entries)
+
+    def remove(self, path):
+        ''' removes path with all its descendants '''
+        with closing(self.connect()) as conn, conn:
+            conn.execute(
+                'DELETE FROM entries WHERE path = ? '
+                'OR (path >= ? AND path < ?)', (path,) + subtree_range(path))
+
+    def search(self, q, path=os.sep, limit=None):
+        ''' paths of entries under path with q in the name '''
+        params = (self._pattern(q),) + subtree_range(path) + (
+            -1 if limit is None else limit,)
+        with closing(self.connect()) as conn:
+            if self._has_fts(conn):
+                query = (
+                    'SELECT entries.path FROM names '
+                    'JOIN entries ON entries.id = names.rowid '
+                    'WHERE names.name GLOB ? '
+                    'AND entries.path >= ? AND entries.path < ? LIMIT ?')
+            else:
+                query = (
+                    'SELECT path FROM entries WHERE name GLOB ? '
+                    'AND path >= ? AND path < ? LIMIT ?')
+            return [x[0] for x in conn.execute(query, params)]
@@ -14,8 +14,13 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 
+from collections import OrderedDict
+
 from rest_framework import serializers
 
+from django.conf import settings
+
+from .archive import ARCHIVERS
 from .models import Node
 
 
@@ -40,18 +45,19 @@ class CmdSerializer(serializers.Serializer):
 
     def validate_cmd(self, value):
         if value not in ('open', 'file', 'tree', 'parents',
-                       # 'ls',
-                       # 'tmb',
-                       # 'size',
+                       'ls',
+                       'tmb',
+                       'size',
                        # 'dim',
                        'mkdir', 'mkfile', 'rm', 'rename',
                        'duplicate', 'paste', 'upload', 'get', 'put',
-                       # 'archive',
+                       'archive',
                        # 'extract',
                        'search',
                        # 'info',
                        'resize',
                        # 'netmount',
+                       'job',
                 ):
             raise serializers.ValidationError('errUnknownCmd')
         return value
@@ -59,6 +65,12 @@ class CmdSerializer(serializers.Serializer):
 
 class SearchCmdSerializer(CmdSerializer):
     q = serializers.CharField(max_length=4096)
+    target = NodeField(required=False)
+
+    def validate_target(self, value):
+        if not value.exists():
+            raise serializers.ValidationError('errFileNotFound')
+        return value
 
 
 class SingleTargetCmdSerializer(CmdSerializer):
@@ -70,6 +82,14 @@ class SingleTargetCmdSerializer(CmdSerializer):
         return value
 
 
+class LsCmdSerializer(SingleTargetCmdSerializer):
+    def get_fields(self):
+        fields = super().get_fields()
+        fields['intersect[]'] = serializers.ListField(
+            child=serializers.CharField(max_length=4096), required=False)
+        return fields
+
+
 class OpenCmdSerializer(CmdSerializer):
     target = NodeField(required=False)
     init = serializers.BooleanField(required=False)
@@ -85,6 +105,31 @@ class OpenCmdSerializer(CmdSerializer):
         return value
 
 
+class UploadCmdSerializer(SingleTargetCmdSerializer):
+    ''' chunk, cid and range are sent by elFinder 2.1 chunked uploads '''
+    chunk = serializers.CharField(max_length=4096, required=False)
+    cid = serializers.CharField(max_length=255, required=False)
+    range = serializers.RegexField(r'^\d+,\d+,\d+$', required=False)
+
+    def validate(self, data):
+        ''' a part carries the file, the merge request the file name '''
+        chunk = data.get('chunk')
+        if chunk:
+            uploads = self.initial_data.get('upload[]') or []
+            if not uploads or (
+                    chunk.endswith('.part') != hasattr(uploads[0], 'chunks')):
+                raise serializers.ValidationError('errUpload')
+        return data
+
+
+class GetCmdSerializer(SingleTargetCmdSerializer):
+    def validate_target(self, value):
+        value = super().validate_target(value)
+        if value.size > settings.ELFINDERFS.get('edit_max_size', 2097152):
+            raise serializers.ValidationError('errFileMaxSize')
+        return value
+
+
 class SingleTargetOpCmdSerializer(SingleTargetCmdSerializer):
     name = serializers.CharField(max_length=4096)
 
@@ -109,6 +154,17 @@ class ResizeCmdSerializer(SingleTargetCmdSerializer):
             raise serializers.ValidationError('errResize')
         return value
 
+    def validate(self, data):
+        ''' images are decoded in memory, so their size is limited '''
+        limit = data['target']._max_pixels
+        dimensions = data['target']._dimensions
+        if not dimensions:
+            raise serializers.ValidationError('errResize')
+        width, height = dimensions
+        if limit and width * height > limit:
+            raise serializers.ValidationError('errResize')
+        return data
+
 
 class MultipleTargetsCmdSerializer(CmdSerializer):
     def get_fields(self):
@@ -127,6 +183,26 @@ class PasteCmdSerializer(MultipleTargetsCmdSerializer):
         return value
 
 
+class ArchiveCmdSerializer(MultipleTargetsCmdSerializer):
+    target = NodeField()
+    type = serializers.CharField(max_length=255)
+    name = serializers.CharField(max_length=4096, required=False)
+
+    def validate_target(self, value):
+        if not value.exists():
+            raise serializers.ValidationError('errFileNotFound')
+        return value
+
+    def validate_type(self, value):
+        if value not in ARCHIVERS:
+            raise serializers.ValidationError('errArcType')
+        return value
+
+
+class JobCmdSerializer(CmdSerializer):
+    id = serializers.RegexField(r'^[0-9a-f]{32}$')
+
+
 # RESPONSE (NODE) SERIALIZERS
 
 
@@ -150,6 +226,52 @@ class NodeSerializer(serializers.Serializer):
     absolute_url = serializers.CharField(max_length=4096)
 
 
+class FastNodeSerializer(object):
+    '''
+    NodeSerializer for the listings without DRF field dispatch.
+    Builds the same plain dicts from the node attributes.
+    '''
+    fields = list(map(
+        lambda x: (x[0], str if isinstance(x[1], serializers.CharField)
+                   else int),
+        NodeSerializer._declared_fields.items()))
+
+    @classmethod
+    def to_representation(cls, node):
+        data = OrderedDict()
+        for name, cast in cls.fields:
+            value = getattr(node, name)
+            data[name] = None if value is None else cast(value)
+        return data
+
+
+class FastSerializer(object):
+    '''
+    Fast path of the response serializers. NodeSerializer fields are
+    built with FastNodeSerializer, other fields are passed to DRF.
+    The output is the same as of the serializer_class.
+    '''
+    def __init__(self, serializer_class):
+        self.fields = serializer_class._declared_fields
+
+    def to_representation(self, instance):
+        data = OrderedDict()
+        for name, field in self.fields.items():
+            if name not in instance and not field.required:
+                continue
+            value = instance[name]
+            if value is None:
+                data[name] = None
+            elif isinstance(field, NodeSerializer):
+                data[name] = FastNodeSerializer.to_representation(value)
+            elif isinstance(getattr(field, 'child', None), NodeSerializer):
+                data[name] = list(map(FastNodeSerializer.to_representation,
+                                      value))
+            else:
+                data[name] = field.to_representation(value)
+        return data
+
+
 class NetDriverSerializer(serializers.Serializer):
     pass
 
@@ -178,13 +300,42 @@ class AddedRemovedNodeSerializer(AddedNodeSerializer, RemovedNodeSerializer):
     pass
 
 
+class LsNodeSerializer(serializers.Serializer):
+    list = serializers.ReadOnlyField()
+
+
+class SizeNodeSerializer(serializers.Serializer):
+    size = serializers.IntegerField()
+
+
+class TmbNodeSerializer(serializers.Serializer):
+    images = serializers.DictField(child=serializers.CharField())
+
+
 class GetNodeSerializer(serializers.Serializer):
     content = serializers.CharField()
 
 
+class JobSerializer(serializers.Serializer):
+    id = serializers.CharField(max_length=32)
+    cmd = serializers.CharField(max_length=32)
+    status = serializers.CharField(max_length=8)
+    done = serializers.IntegerField()
+    total = serializers.IntegerField()
+    error = serializers.CharField(max_length=32)
+
+
+class JobNodeSerializer(serializers.Serializer):
+    job = JobSerializer()
+    added = NodeSerializer(many=True, required=False)
+    removed = HashesField(required=False)
+    changed = NodeSerializer(many=True, required=False)
+
+
 class OpenNodeSerializer(serializers.Serializer):
     cwd = NodeSerializer()
     files = NodeSerializer(many=True)
     netDrivers = NetDriverSerializer(many=True)
     uplMaxSize = serializers.CharField(max_length=32)
     api = serializers.CharField(max_length=8, required=False)
+    options = serializers.ReadOnlyField()
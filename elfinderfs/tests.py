@@ -0,0 +1,677 @@
+# Copyright (C) 2014 Okami, okami@fuzetsu.info
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+import json
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+import unittest
+
+from contextlib import closing
+from unittest import mock
+from urllib.parse import unquote
+
+from PIL import Image
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+from rest_framework.renderers import JSONRenderer
+
+from . import fs, inotify, serializers
+from .cache import ListingCache
+from .fs import DirSizes
+from .models import Node, thumbnail_pool
+from .search import SearchIndex
+from .thumbnails import render
+from .trash import Trash
+
+
+class RootTestCase(TestCase):
+    ''' runs with a single temporary root "Test" '''
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, True)
+        config = dict(settings.ELFINDERFS, default_root='Test', roots={
+            'Test': {
+                'url': '/test/',
+                'root': self.root,
+                'thumbnails_prefix': '.thumbnails',
+            },
+        })
+        override = self.settings(ELFINDERFS=config)
+        override.enable()
+        self.addCleanup(override.disable)
+        # done callbacks of the renders update the root
+        self.addCleanup(thumbnail_pool.shutdown)
+        self.user = User.objects.create_superuser(
+            'admin', 'admin@example.com', 'admin')
+        self.client.force_login(self.user)
+        self.url = reverse('admin:elfinderfs_sitefiles_connector')
+
+    def path(self, *names):
+        return os.path.join(self.root, *names)
+
+    def node(self, path='/'):
+        return Node(root='Test', path=path)
+
+    def connector(self, **data):
+        return json.loads(self.client.post(self.url, data).content.decode())
+
+
+class CountingEntry(object):
+    def __init__(self, entry, counts):
+        self._entry = entry
+        self._counts = counts
+
+    def __getattr__(self, name):
+        return getattr(self._entry, name)
+
+    def stat(self, **kwargs):
+        self._counts['DirEntry.stat'] += 1
+        return self._entry.stat(**kwargs)
+
+
+class CountingScandir(object):
+    def __init__(self, entries, counts):
+        self._entries = entries
+        self._counts = counts
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self._entries.close()
+
+    def __iter__(self):
+        return map(lambda x: CountingEntry(x, self._counts), self._entries)
+
+
+class Syscalls(object):
+    '''
+    Counts file system calls: os functions doing a syscall and stat()
+    of DirEntry objects, which the os module doesn't see.
+    '''
+    names = 'stat', 'lstat', 'access', 'statvfs', 'listdir', 'open'
+    def __init__(self):
+        self.counts = dict.fromkeys(
+            self.names + ('scandir', 'DirEntry.stat'), 0)
+        self._patches = []
+
+    def _counting(self, name, func):
+        def wrapper(*args, **kwargs):
+            self.counts[name] += 1
+            return func(*args, **kwargs)
+        return wrapper
+
+    def __enter__(self):
+        scandir = os.scandir
+        patches = dict(map(
+            lambda x: (x, self._counting(x, getattr(os, x))), self.names))
+        patches['scandir'] = self._counting('scandir', lambda *args: (
+            CountingScandir(scandir(*args), self.counts)))
+        self._patches = list(map(
+            lambda x: mock.patch.object(os, x[0], x[1]), patches.items()))
+        for patch in self._patches:
+            patch.start()
+        return self
+
+    def __exit__(self, *args):
+        for patch in self._patches:
+            patch.stop()
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+
+class JobTest(RootTestCase):
+    def test_removed_since(self):
+        open(self.path('a.txt'), 'w').close()
+        job = {'id': 'a' * 32, 'cmd': 'paste', 'status': 'done', 'done': 2,
+               'total': 2, 'error': None, 'result': {
+                   'added': [self.node('/a.txt').hash,
+                             self.node('/b.txt').hash],
+                   'removed': [self.node('/c.txt').hash], 'changed': []}}
+        queue = mock.Mock(**{'get.return_value': job})
+        with mock.patch('elfinderfs.views.job_queue', queue):
+            response = self.connector(cmd='job', id='a' * 32)
+        self.assertEqual(list(map(lambda x: x['name'], response['added'])),
+                         ['a.txt'])
+        self.assertEqual(response['removed'], [self.node('/c.txt').hash])
+
+    def test_store_kept_by_collect(self):
+        troot = self.node()._troot
+        os.makedirs(troot)
+        for name in ('jobs.sqlite3', 'jobs.sqlite3-journal', 'orphan.png'):
+            open(os.path.join(troot, name), 'w').close()
+        self.assertEqual(self.node().collect_thumbnails(), 1)
+        self.assertEqual(sorted(os.listdir(troot)),
+                         ['jobs.sqlite3', 'jobs.sqlite3-journal'])
+
+class SyscallsTest(RootTestCase):
+    def test_node(self):
+        open(self.path('a.txt'), 'w').close()
+        node = self.node('/a.txt')
+        with Syscalls() as syscalls:
+            data = serializers.NodeSerializer(node).data
+        self.assertEqual(data['name'], 'a.txt')
+        # a snapshot of the node and one of its parent dir, which is
+        # checked with access() too
+        self.assertEqual(syscalls.total, 3)
+
+    def open(self, count):
+        ''' syscalls of the open command listing count files '''
+        shutil.rmtree(self.path('dir'), True)
+        os.makedirs(self.path('dir', 'sub'))
+        for i in range(count):
+            open(self.path('dir', '%d.txt' % i), 'w').close()
+        target = self.node('/dir').hash
+        with Syscalls() as syscalls:
+            response = self.connector(cmd='open', target=target)
+        self.assertEqual(len(response['files']), count + 1)
+        return syscalls
+
+    def test_open(self):
+        small, big = self.open(20), self.open(40)
+        # a stat call per listed file, nothing else depends on the size
+        self.assertEqual(big.total - small.total, 20)
+
+
+class SerializerTest(RootTestCase):
+    def setUp(self):
+        super().setUp()
+        os.makedirs(self.path('dir', 'sub', 'deeper'))
+        os.makedirs(self.path('dir', 'empty'))
+        Image.new('RGB', (40, 30)).save(self.path('dir', 'photo.jpg'))
+        Image.new('RGBA', (16, 16)).save(self.path('dir', 'icon.png'))
+        with open(self.path('dir', 'notes ü.txt'), 'w') as f:
+            f.write('text')
+        open(self.path('dir', 'noext'), 'w').close()
+        self.target = self.node('/dir')
+        # both serializers must see the thumbnails ready
+        Node.thumbnails(self.target.files())
+
+    def assertSameJSON(self, serializer_class, instance):
+        fast = serializers.FastSerializer(serializer_class)
+        self.assertEqual(
+            JSONRenderer().render(fast.to_representation(instance)),
+            JSONRenderer().render(serializer_class(instance).data))
+
+    def test_open(self):
+        files = self.target.files()
+        self.assertEqual(len(files), 6)
+        self.assertSameJSON(serializers.OpenNodeSerializer, {
+            'cwd': self.target,
+            'files': files,
+            'netDrivers': [],
+            'uplMaxSize': '32M',
+            'options': {'archivers': {'create': ['application/zip'],
+                                      'extract': []},
+                        'uploadMaxChunkSize': 10485760},
+            'api': '2.1',
+        })
+
+    def test_tree(self):
+        self.assertSameJSON(serializers.TreeNodeSerializer, {
+            'tree': self.target.subdirs(tree=True)})
+
+    def test_optional_fields(self):
+        job = {'id': 'a' * 32, 'cmd': 'rm', 'status': 'done', 'done': '2',
+               'total': 2, 'error': None}
+        self.assertSameJSON(serializers.JobNodeSerializer, {'job': job})
+        self.assertSameJSON(serializers.JobNodeSerializer, {
+            'job': job, 'added': self.target.files(), 'changed': [],
+            'removed': [self.node('/gone')]})
+
+
+class AllocationsTest(RootTestCase):
+    def open(self, count):
+        '''
+        distinct nodes and peak traced memory of the open command
+        listing count files
+        '''
+        shutil.rmtree(self.path('dir'), True)
+        os.makedirs(self.path('dir'))
+        for i in range(count):
+            open(self.path('dir', '%d.txt' % i), 'w').close()
+        target = self.node('/dir').hash
+        nodes = set()
+        init = Node.__init__
+
+        def spy(node, *args, **kwargs):
+            nodes.add(node)
+            init(node, *args, **kwargs)
+
+        with mock.patch.object(Node, '__init__', spy):
+            tracemalloc.start()
+            try:
+                response = self.connector(cmd='open', target=target)
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+        self.assertEqual(len(response['files']), count)
+        return len(nodes), peak
+
+    def test_open(self):
+        self.open(10)
+        (nodes1, peak1), (nodes2, peak2), (nodes3, peak3) = map(
+            self.open, (200, 400, 800))
+        # a node per listed entry
+        self.assertEqual(nodes2 - nodes1, 200)
+        self.assertEqual(nodes3 - nodes2, 400)
+        # the same memory per entry whatever the dir size
+        per_entry = (peak2 - peak1) / 200
+        self.assertAlmostEqual((peak3 - peak2) / 400, per_entry,
+                               delta=per_entry / 4)
+
+
+class EditTest(RootTestCase):
+    def test_invalid_utf8_after_sample(self):
+        data = b'a' * 70000 + b'\xe9x'
+        with open(self.path('a.txt'), 'wb') as f:
+            f.write(data)
+        target = self.node('/a.txt').hash
+        response = self.connector(cmd='get', target=target)
+        self.assertEqual(response['content'], data.decode('latin-1'))
+        self.connector(cmd='put', target=target, content=response['content'])
+        with open(self.path('a.txt'), 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    def test_not_text(self):
+        with open(self.path('a.txt'), 'wb') as f:
+            f.write(b'\x98\xff')
+        settings.ELFINDERFS['edit_encoding'] = 'cp1251'
+        response = self.connector(cmd='get', target=self.node('/a.txt').hash)
+        self.assertEqual(response['error'], ['errUsupportType'])
+
+
+class UploadTest(RootTestCase):
+    def test_chunked(self):
+        target = self.node().hash
+        response = self.connector(
+            cmd='upload', target=target, cid='1', chunk='big.bin.0_1.part',
+            range='0,3,6',
+            **{'upload[]': SimpleUploadedFile('blob', b'abc')})
+        self.assertNotIn('_chunkmerged', response)
+        response = self.connector(
+            cmd='upload', target=target, cid='1', chunk='big.bin.1_1.part',
+            range='3,3,6',
+            **{'upload[]': SimpleUploadedFile('blob', b'def')})
+        self.assertEqual(response['_name'], 'big.bin')
+        response = self.connector(
+            cmd='upload', target=target, chunk=response['_chunkmerged'],
+            **{'upload[]': 'big.bin'})
+        self.assertEqual(list(map(lambda x: x['name'], response['added'])),
+                         ['big.bin'])
+        with open(self.path('big.bin'), 'rb') as f:
+            self.assertEqual(f.read(), b'abcdef')
+
+    def test_chunk_without_file(self):
+        target = self.node().hash
+        response = self.connector(
+            cmd='upload', target=target, cid='1', chunk='big.bin.0_1.part',
+            range='0,3,6')
+        self.assertEqual(response['error'], ['errUpload'])
+        response = self.connector(
+            cmd='upload', target=target, chunk='a' * 32)
+        self.assertEqual(response['error'], ['errUpload'])
+
+    def test_api(self):
+        response = self.connector(cmd='open', init=1)
+        self.assertEqual(response['api'], '2.1')
+        self.assertEqual(response['options']['uploadMaxChunkSize'], 10485760)
+
+
+class SearchTest(RootTestCase):
+    def test_stale_index(self):
+        for name in 'apple', 'pineapple':
+            open(self.path(name), 'w').close()
+        self.node().build_index()
+        os.remove(self.path('pineapple'))
+        response = self.connector(cmd='search', q='apple')
+        self.assertEqual(list(map(lambda x: x['name'], response['files'])),
+                         ['apple'])
+        self.assertEqual(self.node()._index.search('apple'), ['/apple'])
+
+    def test_journal_mode(self):
+        def journal_mode(index):
+            with closing(index.connect()) as conn:
+                return conn.execute('PRAGMA journal_mode').fetchone()[0]
+        self.node().build_index()
+        index = self.node()._index
+        self.assertEqual(os.path.dirname(index.path), self.root)
+        self.assertEqual(journal_mode(index), 'delete')
+        db_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, db_dir, True)
+        settings.ELFINDERFS['roots']['Test']['db_dir'] = db_dir
+        self.node().build_index()
+        index = self.node()._index
+        self.assertEqual(os.path.dirname(index.path), db_dir)
+        self.assertEqual(journal_mode(index), 'wal')
+
+    def test_build_does_not_lock(self):
+        index = SearchIndex(self.path('index.sqlite3'))
+        index.build([('/a', 'a')])
+        started = threading.Event()
+
+        def entries():
+            started.set()
+            for i in range(20):
+                time.sleep(0.05)
+                yield '/f%s' % i, 'f%s' % i
+
+        builder = threading.Thread(target=index.build, args=(entries(),))
+        builder.start()
+        started.wait()
+        began = time.monotonic()
+        index.add([('/b', 'b')])
+        self.assertLess(time.monotonic() - began, 0.5)
+        builder.join()
+        self.assertEqual(index.search('f1'), ['/f1'] + list(map(
+            lambda x: '/f%s' % x, range(10, 20))))
+
+
+@unittest.skipUnless(inotify.available(), 'inotify is not available')
+class ListingCacheTest(RootTestCase):
+    def mkdir(self, name):
+        os.mkdir(self.path(name))
+        # fresh mtimes are not cached
+        os.utime(self.path(name), (time.time() - 10, time.time() - 10))
+        return self.path(name), os.stat(self.path(name)).st_mtime_ns
+
+    def test_other_process(self):
+        rpath, mtime_ns = self.mkdir('dir')
+        first, second = ListingCache('default'), ListingCache('default')
+        first.set(rpath, mtime_ns, ['a'])
+        self.assertEqual(first.get(rpath, mtime_ns), ['a'])
+        # set by this process, not watched by the second one
+        self.assertIsNone(second.get(rpath, mtime_ns))
+        second.set(rpath, mtime_ns, ['a'])
+        self.assertEqual(second.get(rpath, mtime_ns), ['a'])
+
+    def test_watched_by_other_process(self):
+        rpath, mtime_ns = self.mkdir('dir')
+        listing_cache = ListingCache('default')
+        other = subprocess.Popen(['sleep', '60'])
+        self.addCleanup(other.wait)
+        self.addCleanup(other.kill)
+        listing_cache.cache.set(listing_cache.key(rpath), (
+            mtime_ns, ['a'], (socket.gethostname(), other.pid)))
+        self.assertEqual(listing_cache.get(rpath, mtime_ns), ['a'])
+        other.kill()
+        other.wait()
+        self.assertIsNone(listing_cache.get(rpath, mtime_ns))
+
+    def test_subdir_changed(self):
+        rpath, mtime_ns = self.mkdir('dir')
+        os.mkdir(self.path('dir', 'sub'))
+        os.utime(rpath, ns=(mtime_ns, mtime_ns))
+        with mock.patch('elfinderfs.models.listing_cache',
+                        ListingCache('default')):
+            self.node('/dir').files()
+            # the dir itself is not changed
+            open(self.path('dir', 'sub', 'a'), 'w').close()
+            with mock.patch.object(Node, '_scandir',
+                                   side_effect=AssertionError):
+                sub, = self.node('/dir').files()
+        self.assertEqual(sub._stat.mtime_ns,
+                         os.stat(self.path('dir', 'sub')).st_mtime_ns)
+        self.assertTrue(sub._is_dir)
+
+    def test_release(self):
+        listing_cache = ListingCache('default', max_watches=1)
+        first, first_mtime = self.mkdir('first')
+        second, second_mtime = self.mkdir('second')
+        listing_cache.set(first, first_mtime, ['a'])
+        listing_cache.set(second, second_mtime, ['b'])
+        self.assertFalse(listing_cache.watcher.watching(first))
+        # other processes don't trust the released watch
+        self.assertIsNone(listing_cache.cache.get(listing_cache.key(first)))
+        self.assertIsNone(listing_cache.get(first, first_mtime))
+        self.assertEqual(listing_cache.get(second, second_mtime), ['b'])
+
+
+class DownloadTest(RootTestCase):
+    def test_accel_redirect(self):
+        name = 'file ?%#\u00fc name.txt'
+        os.mkdir(self.path('dir'))
+        open(self.path('dir', name), 'w').close()
+        config = settings.ELFINDERFS['roots']['Test']
+        config.update(sendfile='X-Accel-Redirect',
+                      sendfile_url='/protected/')
+        response = self.client.get(self.url, {
+            'cmd': 'file', 'download': 1,
+            'target': self.node('/dir/' + name).hash})
+        self.assertEqual(response['X-Accel-Redirect'],
+                         '/protected/dir/file%20%3F%25%23%C3%BC%20name.txt')
+
+    def test_sendfile(self):
+        name = 'file %\u00fc.txt'
+        open(self.path(name), 'w').close()
+        settings.ELFINDERFS['roots']['Test']['sendfile'] = 'X-Sendfile'
+        response = self.client.get(self.url, {
+            'cmd': 'file', 'download': 1,
+            'target': self.node('/' + name).hash})
+        self.assertTrue(
+            response['X-Sendfile'].endswith('/file%20%25%C3%BC.txt'))
+        self.assertEqual(unquote(response['X-Sendfile']), self.path(name))
+
+
+class ThumbnailTest(RootTestCase):
+    def test_rename_dir(self):
+        os.makedirs(self.path('dir', 'sub'))
+        Image.new('RGB', (64, 64)).save(self.path('dir', 'sub', 'a.png'))
+        image = self.node('/dir/sub/a.png')
+        image._get_thumbnail()
+        with mock.patch.object(Node, '_walk', side_effect=AssertionError):
+            node = self.node('/dir').rename('moved')
+        moved = self.node('/moved/sub/a.png')
+        self.assertEqual(node._path, '/moved')
+        self.assertFalse(os.path.exists(
+            os.path.join(image._troot, image._tfile)))
+        self.assertTrue(os.path.exists(
+            os.path.join(moved._troot, moved._tfile)))
+        self.assertEqual(moved._meta.get('thumbnail'), 1)
+
+    def test_sniffed_mime(self):
+        # a bitmap named as png
+        Image.new('RGB', (8, 8)).save(self.path('fake.png'), 'BMP')
+        Image.new('RGB', (8, 8)).save(self.path('real.png'))
+        for name in ('fake.png', 'real.png'):
+            self.assertEqual(self.node('/' + name).dim, '8x8')
+        fake, real = self.node('/fake.png'), self.node('/real.png')
+        Node._prefetch_meta([fake, real])
+        self.assertEqual(fake._meta.get('mime'), 'image/bmp')
+        self.assertIsNone(fake.dim)
+        self.assertIsNone(fake.tmb)
+        self.assertEqual(real.dim, '8x8')
+
+    def test_max_pixels(self):
+        Image.new('RGB', (400, 400)).save(self.path('a.jpg'))
+        Image.new('RGB', (200, 200)).save(self.path('a.png'))
+        # JPEG is decoded at 1/4 of its size
+        render(self.path('a.jpg'), self.path('a.jpg.png'), max_pixels=20000)
+        self.assertTrue(os.path.exists(self.path('a.jpg.png')))
+        with self.assertRaises(Image.DecompressionBombError):
+            render(self.path('a.png'), self.path('a.png.png'),
+                   max_pixels=20000)
+        self.assertFalse(os.path.exists(self.path('a.png.png')))
+
+    def test_db_dir(self):
+        Image.new('RGB', (8, 8)).save(self.path('a.png'))
+        self.node('/a.png').dim
+        store = self.node('/a.png')._meta_store
+        self.assertTrue(os.path.exists(store.path))
+        with closing(store.connect()) as conn:
+            self.assertEqual(
+                conn.execute('PRAGMA journal_mode').fetchone()[0], 'delete')
+        db_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, db_dir, True)
+        settings.ELFINDERFS['roots']['Test']['db_dir'] = db_dir
+        self.assertEqual(self.node('/a.png').dim, '8x8')
+        store = self.node('/a.png')._meta_store
+        self.assertEqual(store.path, os.path.join(db_dir, 'meta.sqlite3'))
+        with closing(store.connect()) as conn:
+            self.assertEqual(
+                conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+
+    def test_failed(self):
+        with open(self.path('a.png'), 'wb') as f:
+            f.write(b'not a png')
+        self.assertEqual(Node.thumbnails([self.node('/a.png')]), {})
+        # recorded by the done callback, after the waiters are woken
+        thumbnail_pool.shutdown()
+        self.assertEqual(self.node('/a.png')._meta.get('thumbnail'), -1)
+        with mock.patch('elfinderfs.models.thumbnail_pool.workers', 0), \
+                mock.patch('elfinderfs.models.render',
+                           side_effect=AssertionError):
+            # not rendered again
+            self.assertIsNone(self.node('/a.png').tmb)
+            self.assertEqual(Node.thumbnails([self.node('/a.png')]), {})
+        Image.new('RGB', (8, 8)).save(self.path('a.png'))
+        with mock.patch('elfinderfs.models.thumbnail_pool.workers', 0):
+            node = self.node('/a.png')
+            self.assertEqual(node.tmb, node._tmb_url)
+
+    def test_failed_inline(self):
+        with open(self.path('a.png'), 'wb') as f:
+            f.write(b'not a png')
+        with mock.patch('elfinderfs.models.thumbnail_pool.workers', 0), \
+                self.assertLogs('elfinderfs.models', 'WARNING'):
+            self.assertIsNone(self.node('/a.png').tmb)
+            self.assertEqual(Node.thumbnails([self.node('/a.png')]), {})
+        self.assertEqual(self.node('/a.png')._meta.get('thumbnail'), -1)
+
+    def test_corrupt_image(self):
+        with open(self.path('broken.jpg'), 'wb') as f:
+            f.write(b'not a jpeg')
+        response = self.connector(cmd='open', target=self.node('/').hash)
+        data = next(filter(lambda x: x['name'] == 'broken.jpg',
+                           response['files']))
+        self.assertIsNone(data['dim'])
+        node = self.node('/broken.jpg')
+        self.assertEqual(node._meta.get('mime'), '')
+        self.assertFalse(node._is_image)
+        self.assertIsNone(node.tmb)
+
+
+class TrashTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, True)
+        self.trash = Trash(os.path.join(self.root, '.trash'), keep=3600)
+
+    def test_put_is_atomic(self):
+        rpath = os.path.join(self.root, 'a.txt')
+        open(rpath, 'w').close()
+        rename = os.rename
+        seen = []
+
+        def spy(src, dst):
+            if src == rpath:
+                # a reaper must not find the incomplete batch
+                seen.append(self.trash._batches())
+            rename(src, dst)
+
+        with mock.patch('os.rename', side_effect=spy), \
+                mock.patch.object(self.trash, '_start'):
+            self.assertTrue(self.trash.put(rpath, '/a.txt'))
+        self.assertEqual(seen, [[]])
+        entries = list(self.trash.entries())
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0][1], '/a.txt')
+        self.assertTrue(os.path.exists(entries[0][2]))
+        self.assertFalse(os.path.exists(rpath))
+
+    def test_purge_claims_batch(self):
+        open(os.path.join(self.root, 'a.txt'), 'w').close()
+        with mock.patch.object(self.trash, '_start'):
+            self.trash.put(os.path.join(self.root, 'a.txt'), '/a.txt')
+        rbatch = os.path.dirname(next(self.trash.entries())[2])
+        os.utime(rbatch, (time.time() - 7200,) * 2)
+        ages = []
+        self.trash.on_purge = lambda path, rpath: ages.append(
+            time.time() - os.stat(os.path.dirname(rpath)).st_mtime)
+        self.trash.purge(force=True)
+        # not a leftover for the other reapers
+        self.assertLess(ages[0], 3600)
+        self.assertEqual(os.listdir(self.trash.path), [])
+
+
+@unittest.skipUnless(hasattr(os, 'copy_file_range'),
+                     'copy_file_range is not available')
+class CopyTest(unittest.TestCase):
+    def test_nothing_copied(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, True)
+        src, dst = os.path.join(root, 'src'), os.path.join(root, 'dst')
+        with open(src, 'wb') as f:
+            f.write(b'data')
+        with mock.patch('elfinderfs.fs._clone', return_value=False), \
+                mock.patch('os.copy_file_range', return_value=0):
+            fs.copyfile(src, dst)
+        with open(dst, 'rb') as f:
+            self.assertEqual(f.read(), b'data')
+
+
+class SizeTest(RootTestCase):
+    def test_limit(self):
+        for i in range(10):
+            os.makedirs(self.path('dir', str(i), 'sub'))
+            for path in (('dir', str(i), 'f'), ('dir', str(i), 'sub', 'f')):
+                with open(self.path(*path), 'wb') as f:
+                    f.write(b'x' * 100)
+        sizes = DirSizes()
+        with mock.patch.object(sizes, '_scan', wraps=sizes._scan) as scan:
+            self.assertEqual(sizes.size([self.path('dir')]), 2000)
+            self.assertEqual(scan.call_count, 21)
+        sizes = DirSizes()
+        with mock.patch.object(sizes, '_scan', wraps=sizes._scan) as scan:
+            self.assertEqual(sizes.size([self.path('dir')], limit=150), 200)
+            # the limit is exceeded in the first level, subdirs are skipped
+            self.assertLessEqual(scan.call_count, 11)
+
+    def test_rewritten_in_place(self):
+        os.mkdir(self.path('dir'))
+        with open(self.path('dir', 'f'), 'wb') as f:
+            f.write(b'abc')
+        sizes = DirSizes()
+        self.assertEqual(sizes.size([self.path('dir')]), 3)
+        # the dir mtime is not changed
+        with open(self.path('dir', 'f'), 'ab') as f:
+            f.write(b'de')
+        self.assertEqual(sizes.size([self.path('dir')]), 5)
+
+    def test_move_is_not_measured(self):
+        os.makedirs(self.path('dir', 'sub'))
+        os.makedirs(self.path('dst'))
+        with mock.patch('elfinderfs.views.job_queue', mock.Mock()), \
+                mock.patch.object(Node, 'total_size') as total_size:
+            response = self.connector(
+                cmd='paste', dst=self.node('/dst').hash, cut=1,
+                **{'targets[]': self.node('/dir').hash})
+        self.assertFalse(total_size.called)
+        self.assertEqual(list(map(lambda x: x['name'], response['added'])),
+                         ['dir'])
+        self.assertTrue(os.path.isdir(self.path('dst', 'dir', 'sub')))
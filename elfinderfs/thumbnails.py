@@ -0,0 +1,115 @@
+# Copyright (C) 2014 Okami, okami@fuzetsu.info
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+import multiprocessing
+import os
+import threading
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from PIL import Image
+
+
+SIZE = (50, 50)
+
+
+def open_reduced(src, size, max_pixels=None):
+    '''
+    Opens image decoded at the smallest scale which is still at least
+    twice as big as size. JPEG is decoded in draft mode (by 1/2 .. 1/8),
+    other formats are decoded in full and reduced by an integer factor
+    before resampling, so a full resolution copy is never resampled.
+    Raises DecompressionBombError if more than max_pixels would be
+    decoded.
+    '''
+    image = Image.open(src)
+    target = (size[0] * 2, size[1] * 2)
+    image.draft(image.mode, target)
+    if max_pixels and image.size[0] * image.size[1] > max_pixels:
+        raise Image.DecompressionBombError(
+            '%s is bigger than %s pixels' % (src, max_pixels))
+    factor = min(image.size[0] // target[0], image.size[1] // target[1])
+    # Image.reduce() is available since Pillow 7.0
+    if factor > 1 and hasattr(image, 'reduce'):
+        image = image.reduce(factor)
+    return image
+
+
+def render(src, dst, size=SIZE, max_pixels=None):
+    '''
+    Renders thumbnail of the src image into the dst png file.
+    Runs in the worker processes, so it must not touch django.
+    '''
+    image = open_reduced(src, size, max_pixels)
+    image.thumbnail(size, Image.ANTIALIAS)
+    thumbnail = Image.new('RGBA', size, (255, 255, 255, 0))
+    thumbnail.paste(image, (
+        int((size[0] - image.size[0]) / 2),
+        int((size[1] - image.size[1]) / 2)))
+    # readers never see a half written thumbnail
+    tmp = '%s.%s.tmp' % (dst, os.getpid())
+    thumbnail.save(tmp, 'PNG')
+    os.replace(tmp, dst)
+    return dst
+
+
+class ThumbnailPool(object):
+    '''
+    Renders thumbnails in worker processes, so listings don't wait
+    for image decoding. Each thumbnail is queued only once until
+    it's rendered.
+    '''
+    def __init__(self, workers=2):
+        self.workers = workers
+        self._executor = None
+        self._pending = {}
+        self._lock = threading.RLock()
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            # fork is not safe in threaded web servers
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn'))
+        return self._executor
+
+    def shutdown(self):
+        ''' waits for the queued renders and their done callbacks '''
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
+
+    def _done(self, dst):
+        with self._lock:
+            self._pending.pop(dst, None)
+
+    def submit(self, src, dst, max_pixels=None):
+        ''' queues rendering, returns future '''
+        with self._lock:
+            future = self._pending.get(dst)
+            if future is None:
+                try:
+                    future = self.executor.submit(
+                        render, src, dst, max_pixels=max_pixels)
+                except BrokenProcessPool:
+                    self._executor = None
+                    future = self.executor.submit(
+                        render, src, dst, max_pixels=max_pixels)
+                self._pending[dst] = future
+                future.add_done_callback(lambda x: self._done(dst))
+            return future
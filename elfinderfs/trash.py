@@ -0,0 +1,214 @@
+# Copyright (C) 2014 Okami, okami@fuzetsu.info
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+import ctypes
+import ctypes.util
+import errno
+import itertools
+import os
+import platform
+import shutil
+import threading
+import time
+
+
+# ioprio_set(2) syscall numbers, there is no libc wrapper
+IOPRIO_SET = {'x86_64': 251, 'i386': 289, 'i686': 289,
+              'aarch64': 30, 'armv7l': 314, 'ppc64le': 273}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_BE = 2
+IOPRIO_CLASS_SHIFT = 13
+
+
+def lower_priority():
+    '''
+    Lowest best-effort I/O priority and nice 19 for the calling thread,
+    both are per thread on Linux. Does nothing where unsupported.
+    '''
+    try:
+        tid = threading.get_native_id()
+    except AttributeError:
+        return
+    try:
+        os.setpriority(os.PRIO_PROCESS, tid, 19)
+    except (AttributeError, OSError):
+        pass
+    number = IOPRIO_SET.get(platform.machine())
+    if number is None:
+        return
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.syscall(number, IOPRIO_WHO_PROCESS, tid,
+                     (IOPRIO_CLASS_BE << IOPRIO_CLASS_SHIFT) | 7)
+    except (AttributeError, OSError):
+        pass
+
+
+class Trash(object):
+    '''
+    Deleted nodes are renamed into the trash dir, which takes constant
+    time, and removed by a background reaper thread with lowered
+    priority after keep seconds. Each deleted node gets its own batch
+    dir "<time ns>-<pid>-<n>" holding the node and a ".path" file with
+    its original path. Batches being built or purged are named
+    "~<batch>".
+    '''
+    _instances = {}
+    _lock = threading.Lock()
+    _counter = itertools.count()
+
+    def __init__(self, path, keep=0, on_purge=None):
+        self.path = path
+        self.keep = keep
+        self.on_purge = on_purge
+        self._wakeup = threading.Event()
+        self._pid = None
+
+    @classmethod
+    def get(cls, path, keep=0, on_purge=None):
+        ''' one trash and reaper per dir and process '''
+        with cls._lock:
+            trash = cls._instances.get(path)
+            if trash is None:
+                trash = cls._instances[path] = cls(path, keep, on_purge)
+        if os.path.isdir(path):
+            # purges what is left from the previous run
+            trash._start()
+        return trash
+
+    def _start(self):
+        # forked workers don't inherit threads
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                thread = threading.Thread(target=self._run,
+                                          name='elfinderfs-trash')
+                thread.daemon = True
+                thread.start()
+
+    def put(self, rpath, path):
+        '''
+        Moves rpath into the trash, path is the node path to restore.
+        Returns False if rpath is on another filesystem.
+        '''
+        rpath, path = os.path.normpath(rpath), os.path.normpath(path)
+        name = '%d-%d-%d' % (time.time_ns(), os.getpid(), next(self._counter))
+        # reapers skip the batch until it's complete
+        building = os.path.join(self.path, '~' + name)
+        trashed = os.path.join(building, os.path.basename(rpath))
+        os.makedirs(building)
+        try:
+            with open(os.path.join(building, '.path'), 'w') as f:
+                f.write(path)
+            os.rename(rpath, trashed)
+        except OSError as e:
+            shutil.rmtree(building, ignore_errors=True)
+            if e.errno != errno.EXDEV:
+                raise
+            return False
+        try:
+            os.rename(building, os.path.join(self.path, name))
+        except OSError:
+            os.rename(trashed, rpath)
+            shutil.rmtree(building, ignore_errors=True)
+            raise
+        self._start()
+        self._wakeup.set()
+        return True
+
+    def _batches(self):
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            return []
+        return sorted(filter(lambda x: not x.startswith('~'), names))
+
+    def entries(self):
+        ''' (deleted at, original path, trashed rpath) of trashed nodes '''
+        for batch in self._batches():
+            rbatch = os.path.join(self.path, batch)
+            try:
+                with open(os.path.join(rbatch, '.path')) as f:
+                    path = f.read()
+            except OSError:
+                continue
+            yield (int(batch.split('-')[0]) / 10 ** 9, path,
+                   os.path.join(rbatch, os.path.basename(path)))
+
+    def restore(self, path, rpath):
+        '''
+        Moves the latest trashed node deleted from path back to rpath.
+        Returns False if there is none.
+        '''
+        found = None
+        for entry in self.entries():
+            if entry[1] == path:
+                found = entry
+        if found is None or os.path.lexists(rpath):
+            return False
+        os.rename(found[2], rpath)
+        shutil.rmtree(os.path.dirname(found[2]), ignore_errors=True)
+        return True
+
+    def purge(self, force=False):
+        '''
+        Removes batches older than keep seconds (all with force).
+        Returns seconds till the next batch expires or None.
+        '''
+        next_expiry = None
+        for deleted_at, path, rpath in list(self.entries()):
+            left = deleted_at + self.keep - time.time()
+            if left > 0 and not force:
+                next_expiry = min(left, next_expiry or left)
+                continue
+            rbatch = os.path.dirname(rpath)
+            claimed = os.path.join(self.path, '~' + os.path.basename(rbatch))
+            try:
+                # another worker may be purging it
+                os.rename(rbatch, claimed)
+                # the batch mtime is old, other reapers would take the
+                # claimed one for a leftover
+                os.utime(claimed)
+            except FileNotFoundError:
+                continue
+            if self.on_purge is not None:
+                self.on_purge(path, os.path.join(claimed,
+                                                 os.path.basename(rpath)))
+            shutil.rmtree(claimed, ignore_errors=True)
+        # leftovers of killed workers
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            names = []
+        for name in filter(lambda x: x.startswith('~'), names):
+            rclaimed = os.path.join(self.path, name)
+            try:
+                age = time.time() - os.stat(rclaimed).st_mtime
+            except FileNotFoundError:
+                continue
+            if age > 3600:
+                shutil.rmtree(rclaimed, ignore_errors=True)
+        return next_expiry
+
+    def _run(self):
+        lower_priority()
+        while True:
+            try:
+                timeout = self.purge()
+            except Exception:
+                timeout = 60
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
@@ -18,25 +18,46 @@ import base64
 import itertools
 import json
 import os
+import re
 
 from copy import copy
+from urllib.parse import quote
 
 from rest_framework.generics import RetrieveAPIView
 from rest_framework.permissions import IsAdminUser
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 
 from django.conf import settings
 from django.core.exceptions import PermissionDenied
-from django.http import Http404, HttpResponse
+from django.http import (
+    FileResponse, Http404, HttpResponse, HttpResponseNotModified,
+    StreamingHttpResponse)
 from django.shortcuts import redirect
+from django.utils.http import http_date, parse_http_date_safe
 from django.views.generic import TemplateView
 
-from wsgiref.util import FileWrapper
-
-from .models import Node
+from .archive import ARCHIVERS
+from .models import Node, job_queue
 from . import serializers
 
 
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+CHUNK_RE = re.compile(r'^(.+)\.(\d+)_(\d+)\.part$')
+
+
+def read_range(f, start, length, block_size=64 * 1024):
+    ''' yields length bytes of the file starting from start '''
+    with f:
+        f.seek(start)
+        while length > 0:
+            data = f.read(min(block_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+
+
 class ConnectorView(RetrieveAPIView):
     permission_classes = IsAdminUser,
 
@@ -48,26 +69,37 @@ class ConnectorView(RetrieveAPIView):
             result[k] = v
         return result
 
-    def get_serializer(self, *args, **kwargs):
-        ''' response serializer '''
+    # listing commands, their responses are built with FastSerializer
+    fast_cmds = 'open', 'tree', 'parents', 'search'
+
+    def get_serializer_class(self):
+        ''' response serializer class '''
         data = self.request.data or self.request.query_params
         cmd = data.get('cmd')
-        serializer = {
+        return {
             'tree': serializers.TreeNodeSerializer,
             'parents': serializers.TreeNodeSerializer,
             'search': serializers.FilesNodeSerializer,
             'mkdir': serializers.AddedNodeSerializer,
             'mkfile': serializers.AddedNodeSerializer,
             'duplicate': serializers.AddedNodeSerializer,
+            'archive': serializers.AddedNodeSerializer,
             'rm': serializers.RemovedNodeSerializer,
             'resize': serializers.ChangedNodeSerializer,
             'put': serializers.ChangedNodeSerializer,
             'rename': serializers.AddedRemovedNodeSerializer,
             'paste': serializers.AddedRemovedNodeSerializer,
             'get': serializers.GetNodeSerializer,
+            'ls': serializers.LsNodeSerializer,
+            'tmb': serializers.TmbNodeSerializer,
+            'size': serializers.SizeNodeSerializer,
             'open': serializers.OpenNodeSerializer,
+            'job': serializers.JobNodeSerializer,
         }.get(cmd)
-        return serializer(*args, **kwargs)
+
+    def get_serializer(self, *args, **kwargs):
+        ''' response serializer '''
+        return self.get_serializer_class()(*args, **kwargs)
 
     def get_cmd_serializer_class(self):
         data = self.request.data or self.request.query_params
@@ -77,8 +109,9 @@ class ConnectorView(RetrieveAPIView):
             'search': serializers.SearchCmdSerializer,
             'tree': serializers.SingleTargetCmdSerializer,
             'parents': serializers.SingleTargetCmdSerializer,
-            'get': serializers.SingleTargetCmdSerializer,
-            'upload': serializers.SingleTargetCmdSerializer,
+            'get': serializers.GetCmdSerializer,
+            'ls': serializers.LsCmdSerializer,
+            'upload': serializers.UploadCmdSerializer,
             'mkfile': serializers.SingleTargetOpCmdSerializer,
             'mkdir': serializers.SingleTargetOpCmdSerializer,
             'rename': serializers.SingleTargetOpCmdSerializer,
@@ -87,8 +120,12 @@ class ConnectorView(RetrieveAPIView):
             'put': serializers.PutCmdSerializer,
             'resize': serializers.ResizeCmdSerializer,
             'rm': serializers.MultipleTargetsCmdSerializer,
+            'tmb': serializers.MultipleTargetsCmdSerializer,
+            'size': serializers.MultipleTargetsCmdSerializer,
             'duplicate': serializers.MultipleTargetsCmdSerializer,
             'paste': serializers.PasteCmdSerializer,
+            'archive': serializers.ArchiveCmdSerializer,
+            'job': serializers.JobCmdSerializer,
         }.get(cmd, serializers.CmdSerializer)
 
     def get_cmd_serializer(self, data):
@@ -99,6 +136,52 @@ class ConnectorView(RetrieveAPIView):
     def get_cmd_serializer_errors(self, serializer):
         return list(itertools.chain(*serializer.errors.values()))
 
+    def track_changes(self, added=(), removed=(), changed=()):
+        Node.track_changes(added, removed, changed)
+
+    def batch(self, cmd, targets, **params):
+        '''
+        Runs the modifying command in place, or as a background job if
+        the targets are bigger than jobs_threshold. Moving to the trash
+        and moving within a filesystem are renames, fast whatever the
+        size, so the targets are not even measured.
+        '''
+        if job_queue and not (
+                cmd == 'rm' and all(map(
+                    lambda x: x._trash is not None, targets)) or
+                cmd == 'paste' and params.get('cut') and all(map(
+                    lambda x: x._stat.dev == params['dst']._stat.dev,
+                    targets))):
+            threshold = settings.ELFINDERFS['jobs_threshold']
+            if Node.total_size(targets, threshold) > threshold:
+                if 'dst' in params:
+                    params['dst'] = params['dst'].hash
+                job_id = job_queue.submit(
+                    cmd, len(targets), 'elfinderfs.models.run_batch', cmd,
+                    list(map(lambda x: x.hash, targets)), params)
+                return {'job': job_queue.get(job_id)}
+        return Node.batch(cmd, targets, **params)
+
+    def retrieve(self, request, *args, **kwargs):
+        instance = self.get_object()
+        if instance and 'job' not in instance:
+            # jobs keep track of their changes themselves
+            self.track_changes(added=instance.get('added', ()),
+                               removed=instance.get('removed', ()),
+                               changed=instance.get('changed', ()))
+        if instance and 'job' in instance:
+            serializer = serializers.JobNodeSerializer(instance)
+            return Response(serializer.data)
+        data = self.request.data or self.request.query_params
+        if instance and data.get('cmd') in self.fast_cmds:
+            serializer = serializers.FastSerializer(
+                self.get_serializer_class())
+            return HttpResponse(
+                JSONRenderer().render(serializer.to_representation(instance)),
+                content_type='application/json')
+        serializer = self.get_serializer(instance)
+        return Response(serializer.data)
+
     def get_object(self):
         data = self.parse_query(self.request.data or self.request.query_params)
         serializer = self.get_cmd_serializer(data=data)
@@ -115,23 +198,33 @@ class ConnectorView(RetrieveAPIView):
                         'netDrivers': [],
                         'uplMaxSize': settings.ELFINDERFS.get(
                             'uplMaxSize', '32M'),
+                        'options': {
+                            'archivers': {
+                                'create': list(ARCHIVERS),
+                                'extract': [],
+                            },
+                            'uploadMaxChunkSize': settings.ELFINDERFS.get(
+                                'uploadMaxChunkSize', 10485760),
+                        },
                     }
-                    # if cmd.get('init'):
-                    #     response['api'] = '2.0'
-                    response['api'] = '2.0'
+                    # chunked uploads and ls intersect are of 2.1
+                    response['api'] = '2.1'
                     return response
                 # TREE #
                 if cmd['cmd'] == 'tree':
-                    return {'tree': cmd['target'].files(tree=True)}
+                    return {'tree': cmd['target'].subdirs(tree=True)}
                 # PARENTS #
                 elif cmd['cmd'] == 'parents':
                     return {'tree': cmd['target'].parents()}
                 # LS #
-                # -- Not implemented --
+                elif cmd['cmd'] == 'ls':
+                    return {'list': cmd['target'].ls(cmd.get('intersect[]'))}
                 # TMB #
-                # -- Not implemented --
+                elif cmd['cmd'] == 'tmb':
+                    return {'images': Node.thumbnails(cmd['targets[]'])}
                 # SIZE #
-                # -- Not implemented --
+                elif cmd['cmd'] == 'size':
+                    return {'size': Node.total_size(cmd['targets[]'])}
                 # DIM #
                 # -- Not implemented --
                 # MKDIR #
@@ -146,11 +239,7 @@ class ConnectorView(RetrieveAPIView):
                     }
                 # RM #
                 elif cmd['cmd'] == 'rm':
-                    removed = []
-                    for target in cmd['targets[]']:
-                        target.delete()
-                        removed.append(target)
-                    return {'removed': removed}
+                    return self.batch('rm', cmd['targets[]'])
                 # RENAME #
                 elif cmd['cmd'] == 'rename':
                     return {
@@ -159,33 +248,24 @@ class ConnectorView(RetrieveAPIView):
                     }
                 # DUPLICATE #
                 elif cmd['cmd'] == 'duplicate':
-                    added = []
-                    for target in cmd['targets[]']:
-                        added.append(target.duplicate())
-                    return {'added': added}
+                    return self.batch('duplicate', cmd['targets[]'])
                 # PASTE #
                 elif cmd['cmd'] == 'paste':
-                    added = []
-                    removed = []
-                    for target in cmd['targets[]']:
-                        added.append(target.copy(cmd['dst'],
-                                                 cut=cmd.get('cut')))
-                        if cmd.get('cut'):
-                            removed.append(target)
-                    return {
-                        'added': added,
-                        'removed': removed,
-                    }
+                    return self.batch('paste', cmd['targets[]'],
+                                      dst=cmd['dst'], cut=cmd.get('cut'))
                 # GET #
                 elif cmd['cmd'] == 'get':
-                    return {'content': cmd['target'].open().read().decode('utf-8')}
+                    return {'content': cmd['target'].read_text()}
                 # ARCHIVE #
-                # -- Not implemented --
+                elif cmd['cmd'] == 'archive':
+                    return self.batch('archive', cmd['targets[]'],
+                                      dst=cmd['target'], type=cmd['type'],
+                                      name=cmd.get('name'))
                 # EXTRACT #
                 # -- Not implemented --
                 # SEARCH #
                 elif cmd['cmd'] == 'search':
-                    return {'files': Node.search(cmd['q'])}
+                    return {'files': Node.search(cmd['q'], cmd.get('target'))}
                 # INFO #
                 # -- Not implemented --
                 # RESIZE #
@@ -193,15 +273,25 @@ class ConnectorView(RetrieveAPIView):
                     params = dict(filter(lambda x: x[0] in (
                         'x', 'y', 'width', 'height', 'mode'),
                         cmd.items()))
-                    cmd['target'].resize(**params)
-                    return {'changed': [cmd['target']]}
+                    return self.batch('resize', [cmd['target']], **params)
                 # NETMOUNT #
                 # -- Not implemented --
+                # JOB #
+                elif cmd['cmd'] == 'job':
+                    job = job_queue and job_queue.get(cmd['id'])
+                    if not job:
+                        raise Http404({'error': ['errFileNotFound']})
+                    response = {'job': job}
+                    for key, hashes in (job['result'] or {}).items():
+                        nodes = list(map(lambda x: Node(hash_=x), hashes))
+                        if key != 'removed':
+                            # changed again since the job was done
+                            nodes = list(filter(lambda x: x.exists(), nodes))
+                        response[key] = nodes
+                    return response
                 # PUT #
                 if cmd['cmd'] == 'put':
-                    f = cmd['target'].open('w')
-                    f.write(cmd['content'])
-                    f.close()
+                    cmd['target'].write_text(cmd['content'])
                     return {'changed': [cmd['target']]}
             except PermissionError as e:
                 raise PermissionDenied({'error': ['errPerm']})
@@ -215,20 +305,36 @@ class ConnectorView(RetrieveAPIView):
         if serializer.is_valid():
             cmd = serializer.validated_data
             uploads = request.FILES.getlist('upload[]')
+            chunk = cmd.get('chunk')
             added = []
+            merged = {}
             try:
-                for upload in uploads:
-                    new_node = cmd['target'].mkfile(upload.name)
-                    f = new_node.open('wb')
-                    f.write(upload.read())
-                    f.close()
-                    added.append(new_node)
+                if chunk and CHUNK_RE.match(chunk):
+                    # a part of the chunked upload
+                    name, index, last = CHUNK_RE.match(chunk).groups()
+                    start = int(cmd.get('range', '0').split(',')[0])
+                    chunk_id = cmd['target'].write_chunk(
+                        uploads[0], name, cmd.get('cid', ''),
+                        int(index), int(last) + 1, start)
+                    if chunk_id:
+                        merged = {'_chunkmerged': chunk_id, '_name': name}
+                elif chunk:
+                    # all the parts are merged, upload[] is the file name
+                    added.append(cmd['target'].merge_chunks(
+                        chunk, data['upload[]'][0]))
+                else:
+                    for upload in uploads:
+                        added.append(cmd['target'].save_upload(upload))
             except PermissionError as e:
                 response = {'error': ['errPerm']}
             except FileNotFoundError as e:
                 response = {'error': ['errFileNotFound']}
+            except OSError as e:
+                response = {'error': ['errUpload']}
             else:
+                self.track_changes(added=added)
                 response = {'added': serializers.NodeSerializer(added, many=True).data}
+                response.update(merged)
         else:
             response = {
                 'error': self.get_cmd_serializer_errors(serializer),
@@ -236,6 +342,85 @@ class ConnectorView(RetrieveAPIView):
         return HttpResponse(json.dumps(response),
                             content_type='application/json')
 
+    def get_range(self, request, size, etag, last_modified):
+        '''
+        Returns (start, end) of a single byte range request, None if
+        the whole file should be sent or False if it's unsatisfiable.
+        '''
+        match = RANGE_RE.match(request.META.get('HTTP_RANGE', '').strip())
+        if_range = request.META.get('HTTP_IF_RANGE')
+        if (not match or not any(match.groups()) or
+                if_range and if_range not in (etag, last_modified)):
+            return None
+        first, last = match.groups()
+        if not first:
+            start, end = max(size - int(last), 0), size - 1
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+        if start > end:
+            return False
+        return start, end
+
+    def download(self, request, node):
+        '''
+        Sends file with conditional GET and byte ranges support.
+        If "sendfile" option of the root is set, sending is offloaded
+        to the front-end server with X-Sendfile or X-Accel-Redirect.
+        '''
+        st = node._stat
+        etag = '"%x-%x"' % (st.mtime_ns, st.size)
+        last_modified = http_date(st.mtime)
+
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if_modified_since = parse_http_date_safe(
+            request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+        if if_none_match is not None:
+            not_modified = if_none_match.strip() == '*' or etag in map(
+                lambda x: x.strip(), if_none_match.split(','))
+        else:
+            not_modified = (if_modified_since is not None and
+                            if_modified_since >= int(st.mtime))
+        if not_modified:
+            response = HttpResponseNotModified()
+        else:
+            sendfile = node._config.get('sendfile')
+            if sendfile == 'X-Accel-Redirect':
+                response = HttpResponse(content_type=node.mime)
+                # nginx parses it as an URI
+                response[sendfile] = (node._config['sendfile_url'] +
+                                      quote(os.fsencode(
+                                          node._path.lstrip(os.sep))))
+            elif sendfile == 'X-Sendfile':
+                response = HttpResponse(content_type=node.mime)
+                # headers are latin-1, mod_xsendfile unescapes the path
+                response[sendfile] = quote(os.fsencode(node._rpath))
+            else:
+                bytes_range = self.get_range(request, st.size, etag,
+                                             last_modified)
+                if bytes_range is False:
+                    response = HttpResponse(status=416)
+                    response['Content-Range'] = 'bytes */%s' % st.size
+                elif bytes_range:
+                    start, end = bytes_range
+                    response = StreamingHttpResponse(
+                        read_range(node.open(), start, end - start + 1),
+                        status=206, content_type=node.mime)
+                    response['Content-Range'] = 'bytes %s-%s/%s' % (
+                        start, end, st.size)
+                    response['Content-Length'] = end - start + 1
+                else:
+                    # the server may send it with sendfile(2)
+                    response = FileResponse(node.open(),
+                                            content_type=node.mime)
+                    response['Content-Length'] = st.size
+                response['Accept-Ranges'] = 'bytes'
+            response['Content-Disposition'] = (
+                'attachment; filename=%s' % node.name)
+        response['ETag'] = etag
+        response['Last-Modified'] = last_modified
+        return response
+
     def cmd(self, request, *args, **kwargs):
         data = self.parse_query(self.request.data or self.request.query_params)
         serializer = self.get_cmd_serializer(data=data)
@@ -245,12 +430,7 @@ class ConnectorView(RetrieveAPIView):
                 # FILE #
                 if cmd['cmd'] == 'file':
                     if cmd.get('download'):
-                        response = HttpResponse(
-                            FileWrapper(cmd['target'].open()),
-                            content_type=cmd['target'].mime)
-                        response['Content-Disposition'] = (
-                            'attachment; filename=%s' % cmd['target'].name)
-                        return response
+                        return self.download(request, cmd['target'])
                     else:
                         return redirect(cmd['target'])
                 # PING #
@@ -271,12 +451,19 @@ class ConnectorView(RetrieveAPIView):
                 return Response({'error': ['errFileNotFound']})
             except Http404 as e:
                 return Response({'error': ['errFileNotFound']})
+            except UnicodeDecodeError as e:
+                # not a text file in the detected encoding
+                return Response({'error': ['errUsupportType']})
         else:
             return Response({
                 'error': self.get_cmd_serializer_errors(serializer),
             })
         return Response({'error': ['errUnknownCmd']})
 
+    def dispatch(self, request, *args, **kwargs):
+        with Node.identity_map():
+            return super().dispatch(request, *args, **kwargs)
+
     def get(self, request, *args, **kwargs):
         return self.cmd(request, *args, **kwargs)
 
@@ -62,18 +62,25 @@ data = {
     'url': 'https://pypi.python.org/pypi/django-elfinderfs',
     'packages': [
         'elfinderfs',
+        'elfinderfs.management',
+        'elfinderfs.management.commands',
         'elfinderfs.migrations',
     ],
     'long_description': '',
     'classifiers': [
         'Development Status :: 3 - Alpha',
         'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
         'License :: OSI Approved :: GNU General Public License v3 or later (GPLv3+)',
         'Framework :: Django',
     ],
+    # time.time_ns(), threading.get_native_id()
+    'python_requires': '>= 3.8',
     'install_requires': [
-        'Django >= 1.9.2',
-        'Pillow >= 2.8',
+        # 2.0 removed django.core.urlresolvers, older ones fail on python 3.8
+        'Django >= 1.11, < 2.0',
+        # Image.ANTIALIAS is removed in 10.0
+        'Pillow >= 2.8, < 10',
         'djangorestframework >= 3.2',
     ],
     'data_files': find_data_files('elfinderfs/static', '*.*'),
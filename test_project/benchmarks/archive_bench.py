@@ -0,0 +1,110 @@
+# Copyright (C) 2014 Okami, okami@fuzetsu.info
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+
+'''
+Archives a generated tree with the parallel writers of elfinderfs.archive
+and with single-threaded zipfile and tarfile, reports throughput of the
+uncompressed data and archive sizes.
+'''
+
+import argparse
+import os
+import shutil
+import tarfile
+import tempfile
+import zipfile
+
+from bench import best
+
+from elfinderfs.archive import write_tar_gz, write_zip
+
+
+def make_tree(rpath, files, size):
+    ''' half compressible text, half random data '''
+    text = b''.join(map(lambda x: b'line %d of the sample text\n' % x,
+                        range(size // 24 + 1)))[:size]
+    members = []
+    for i in range(files):
+        name = 'file%d.%s' % (i, 'txt' if i % 2 else 'bin')
+        with open(os.path.join(rpath, name), 'wb') as f:
+            f.write(text if i % 2 else os.urandom(size))
+        members.append((os.path.join(rpath, name), name))
+    return members
+
+
+def zipfile_zip(fileobj, members, level):
+    with zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_DEFLATED,
+                         compresslevel=level) as archive:
+        for rpath, arcname in members:
+            archive.write(rpath, arcname)
+
+
+def tarfile_tar_gz(fileobj, members, level):
+    with tarfile.open(fileobj=fileobj, mode='w:gz',
+                      compresslevel=level) as archive:
+        for rpath, arcname in members:
+            archive.add(rpath, arcname, recursive=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=16)
+    parser.add_argument('--size', type=int, default=16,
+                        help='size of each file in MB')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--level', type=int, default=6)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='elfinderfs-bench-')
+    try:
+        src = os.path.join(tmp, 'src')
+        os.mkdir(src)
+        members = make_tree(src, args.files, args.size << 20)
+        total = args.files * (args.size << 20)
+        dst = os.path.join(tmp, 'archive')
+        writers = (
+            ('write_zip', lambda f: write_zip(
+                f, members, args.workers, args.level)),
+            ('zipfile', lambda f: zipfile_zip(f, members, args.level)),
+            ('write_tar_gz', lambda f: write_tar_gz(
+                f, members, args.workers, args.level)),
+            ('tarfile w:gz', lambda f: tarfile_tar_gz(
+                f, members, args.level)),
+        )
+        print('%d MB in %d files, %d workers' % (
+            total >> 20, args.files, args.workers))
+        for name, writer in writers:
+            def run():
+                with open(dst, 'wb') as f:
+                    writer(f)
+            seconds = best(run, args.repeat)
+            print('%-14s %8.1f MB/s %10d KB' % (
+                name, total / seconds / (1 << 20), os.path.getsize(dst) >> 10))
+            # the parallel writers output must be valid archives
+            if 'zip' in name:
+                with zipfile.ZipFile(dst) as archive:
+                    assert archive.testzip() is None
+            else:
+                with tarfile.open(dst) as archive:
+                    assert len(archive.getmembers()) == len(members)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+# Copyright (C) 2014 Okami, okami@fuzetsu.info
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+
+'''
+Shared setup of the benchmarks. They are run from the test_project
+dir, e.g. python benchmarks/serializers_bench.py
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'test_project.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.conf import settings  # noqa: E402
+
+
+@contextmanager
+def temp_root(name='Bench'):
+    ''' yields real path of a temporary root added to the settings '''
+    rpath = tempfile.mkdtemp(prefix='elfinderfs-bench-')
+    settings.ELFINDERFS['roots'][name] = {
+        'url': '/bench/',
+        'root': rpath,
+        'thumbnails_prefix': '.thumbnails',
+    }
+    try:
+        yield rpath
+    finally:
+        del settings.ELFINDERFS['roots'][name]
+        shutil.rmtree(rpath, ignore_errors=True)
+
+
+def best(func, repeat=5):
+    ''' best wall time of repeat calls, in seconds '''
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
@@ -0,0 +1,74 @@
+# Copyright (C) 2014 Okami, okami@fuzetsu.info
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+
+'''
+Renders an open response of a large dir with the FastSerializer and
+with the DRF OpenNodeSerializer, reports time per node.
+'''
+
+import argparse
+import os
+
+from bench import best, temp_root
+
+from PIL import Image
+from rest_framework.renderers import JSONRenderer
+
+from elfinderfs.models import Node
+from elfinderfs.serializers import FastSerializer, OpenNodeSerializer
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with temp_root() as rpath:
+        for i in range(args.files):
+            if i % 10 == 0:
+                os.mkdir(os.path.join(rpath, 'dir%d' % i))
+            elif i % 10 == 1:
+                Image.new('RGB', (8, 8)).save(
+                    os.path.join(rpath, 'image%d.png' % i))
+            else:
+                open(os.path.join(rpath, 'file%d.txt' % i), 'w').close()
+        target = Node(root='Bench', path='/')
+        files = target.files(root=False)
+        Node.thumbnails(files)
+        instance = {
+            'cwd': target,
+            'files': files,
+            'netDrivers': [],
+            'uplMaxSize': '32M',
+            'options': {},
+            'api': '2.0',
+        }
+        fast = FastSerializer(OpenNodeSerializer)
+        results = (
+            ('FastSerializer', best(lambda: JSONRenderer().render(
+                fast.to_representation(instance)), args.repeat)),
+            ('OpenNodeSerializer', best(lambda: JSONRenderer().render(
+                OpenNodeSerializer(instance).data), args.repeat)),
+        )
+        for name, seconds in results:
+            print('%-20s %8.3f s %8.1f us/node' % (
+                name, seconds, seconds / len(files) * 10 ** 6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+# Copyright (C) 2014 Okami, okami@fuzetsu.info
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+
+'''
+Renders thumbnails of a large JPEG and PNG with render(), which decodes
+them with open_reduced(), and with the render path it replaced, reports
+time per thumbnail and peak memory (ru_maxrss) of the rendering process.
+'''
+
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+import bench  # noqa: F401, sets up the paths
+
+from PIL import Image
+
+from elfinderfs.thumbnails import SIZE, open_reduced, render
+
+
+def render_before(src, dst, size=SIZE):
+    ''' thumbnail rendering as it was before open_reduced() '''
+    image = Image.open(src)
+    image.thumbnail(size, Image.ANTIALIAS)
+    thumbnail = Image.new('RGBA', size, (255, 255, 255, 0))
+    thumbnail.paste(image, (
+        int((size[0] - image.size[0]) / 2),
+        int((size[1] - image.size[1]) / 2)))
+    thumbnail.save(dst, 'PNG')
+
+
+def measure(func, src, dst, repeat):
+    ''' runs in a fresh process, so ru_maxrss is of this render only '''
+    start = time.perf_counter()
+    for i in range(repeat):
+        func(src, dst)
+    seconds = (time.perf_counter() - start) / repeat
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return seconds, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--width', type=int, default=6000)
+    parser.add_argument('--height', type=int, default=4000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='elfinderfs-bench-')
+    image = Image.merge('RGB', list(map(
+        lambda x: Image.effect_noise((args.width // 8, args.height // 8),
+                                     64).resize((args.width, args.height)),
+        range(3))))
+    sources = []
+    for ext, options in (('jpg', {'quality': 90}), ('png', {})):
+        src = os.path.join(tmp, 'large.' + ext)
+        image.save(src, **options)
+        sources.append(src)
+    del image
+    # ru_maxrss is the high-water mark of the process, each render
+    # runs in a new one
+    context = multiprocessing.get_context('spawn')
+    print('%-10s %-8s %10s %14s' % ('image', 'render', 'ms/thumb',
+                                   'maxrss KB'))
+    try:
+        for src in sources:
+            for name, func in (('reduced', render), ('before', render_before)):
+                with context.Pool(1) as pool:
+                    seconds, peak = pool.apply(measure, (
+                        func, src, os.path.join(tmp, 'thumb.png'),
+                        args.repeat))
+                print('%-10s %-8s %10.1f %14d' % (
+                    os.path.basename(src), name, seconds * 1000, peak))
+        # PNG is decoded in full and then reduced, JPEG in draft mode
+        for src in sources:
+            print('%s is resampled from %sx%s' % (
+                os.path.basename(src), *open_reduced(src, SIZE).size))
+    finally:
+        for name in os.listdir(tmp):
+            os.remove(os.path.join(tmp, name))
+        os.rmdir(tmp)
+
+
+if __name__ == '__main__':
+    main()